@@ -1,5 +1,4 @@
 import numpy as np
-import json
 import geopandas as gpd
 import pandas as pd
 import h3
@@ -7,6 +6,7 @@ import matplotlib.pyplot as plt
 from shapely.geometry import Polygon, Point
 
 import parameters as prm
+from grid import get_cells, country_grid
 
 from tqdm import tqdm
 tqdm.pandas()
@@ -49,66 +49,44 @@ def wa(x):
     return logistic(kappa_a, gamma_a, x)
 
 
-def wcas(mean, x):
-    # Paramètres à discuter
-    return 1 / (1 + np.exp(-0.5*(x-mean)))
-
-
-###########################
-# Cadrillage d'un pays
-###########################
-
-# GeoJSON : https://geojson-maps.ash.ms/
-
-def swap_lng_lat(geoJSON_Polygon):
-    # Les coordonnées des points du geoJSON sont dans l'ordre (lng, lat)
-    # mais h3.polyfills() prend des coordonnées dans l'ordre (lat, lng).
-    # Il faut donc les échanger dans le JSON.
-    geoJSON_Polygon['coordinates'][0] = [[coord[1], coord[0]] for coord in geoJSON_Polygon['coordinates'][0]]
-
-
-def json_to_h3(country, res):
+def age_weights(n_days):
     """
-    Remplit une surface avec des hexagones.
-
-    Parameters
-    ----------
-    fObj : TextIOWrapper
-        Un fichier ouvert avec open()
-    res : int
-        Résolution H3, entre 1 et 16
-
-    Returns
-    -------
-    Liste des identifiants des cellules H3 remplissant la surface.
+    Table des poids wa pour des âges de 0 à n_days - 1 jours.
+    Les âges des évènements sont des nombres entiers de jours : on calcule
+    la logistique une fois par âge possible, et non pour chaque évènement.
     """
-    path = f"../GeoJSONs/{country}.geo.json"
-    fObj = open(path)
-
-    s = json.load(fObj)
-    s = s['features'][0]['geometry']
-    swap_lng_lat(s)
-    return h3.polyfill(s, res = res)
+    return wa(np.arange(n_days))
 
 
-def add_geometry(row):
-    points = h3.h3_to_geo_boundary(row['h3'], True)
-    return Polygon(points)
+def age_horizon(tol):
+    """
+    Age (en jours) au-delà duquel wa est inférieur à tol.
+    """
+    return int(np.ceil((kappa_a + np.log(1/tol - 1)) / gamma_a))
 
 
-def country_grid(country, res):
+def lookup_wa(ages, wa_table):
     """
-    Crée un GeoDataFrame contenant les Polygons de toutes les cellules remplissant le pays.
+    Lit les poids wa des âges (en jours) dans la table.
+    Les évènements qui n'ont pas encore eu lieu (âge < 0) ne sont pas pris en compte.
     """
-    h3 = json_to_h3(country, res)
+    res = np.zeros(len(ages))
+    past = ages >= 0
+    res[past] = wa_table[ages[past]]
+    return res
 
-    df = pd.DataFrame(h3, columns = ['h3'])
 
-    df['geometry'] = df.apply(add_geometry, axis=1)
-    
-    return gpd.GeoDataFrame(df, crs='EPSG:4326')
+def wcas(mean, x):
+    # Paramètres à discuter
+    return 1 / (1 + np.exp(-0.5*(x-mean)))
 
 
+###########################
+# Cadrillage d'un pays
+###########################
+
+# GeoJSON : https://geojson-maps.ash.ms/
+
 def plot_grid(country, res):
     gdf = country_grid(country, res)
 
@@ -139,59 +117,97 @@ def plot_grid(country, res):
 # https://rechneronline.de/pi/hexagon.php
 
 
-def calc_distances(cells, events):
-    distances = pd.DataFrame(index=events.index)
-    distances['h3'] = events['h3'].copy()
-
-    def calc_event_distance(origin, row):
-        cell_lat, cell_lng = h3.h3_to_geo(origin)
-        ev_lat, ev_lng = row['latitude'], row['longitude']
-        return harvesine(cell_lng, cell_lat, ev_lng, ev_lat)
+def int_ring(origin):
+    """
+    2-ring de la cellule origin, sous forme d'identifiants entiers
+    (comme la colonne h3 des évènements, voir precleaning.grid).
+    """
+    return [h3.string_to_h3(c) for c in h3.k_ring(origin, 2)]
 
 
-    for cell in cells:
-        ring = h3.k_ring(cell, 2)
-        c_events = events.loc[(events['h3'].isin(ring))].copy()
+def calc_distances(cells, events):
+    """
+    Poids wd de chaque couple (cellule, évènement situé dans son 2-ring).
 
-        c_events['distance'] = c_events.apply(lambda row: calc_event_distance(cell, row), axis = 1, result_type='reduce')
-        c_events['wd'] = c_events.apply(lambda row: wd(row['distance']), axis = 1, result_type='reduce')
-       
-       #distances[cell] = c_events['distance']
+    Les évènements sont regroupés une seule fois par cellule H3 : le 2-ring de
+    chacune de ces cellules n'est développé qu'une fois, puis toutes les distances
+    sont calculées d'un coup (harvesine opère sur des tableaux).
 
-        distances[cell] = c_events['wd']
+    Returns
+    -------
+    distances : DataFrame au format long, trié par cellule
+        * cell : identifiant de la cellule (str)
+        * event : position de l'évènement dans events (l'index de events,
+          issu de la concaténation de GED et GTD, n'est pas unique)
+        * wd : poids de la distance entre le centre de la cellule et l'évènement
+    """
+    cells = list(cells)
+    cell_index = {h3.string_to_h3(cell): i for i, cell in enumerate(cells)}
+
+    # Evènements regroupés par cellule H3
+    codes, uniques = pd.factorize(events['h3'].to_numpy())
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+    # Couples (cellule de la grille, groupe d'évènements de son 2-ring)
+    pair_cells, pair_groups = [], []
+    for u, h in enumerate(uniques):
+        for c in int_ring(h3.h3_to_string(int(h))):
+            if c in cell_index:
+                pair_cells.append(cell_index[c])
+                pair_groups.append(u)
+    pair_cells = np.array(pair_cells, dtype=np.int64)
+    pair_groups = np.array(pair_groups, dtype=np.int64)
+
+    # Un couple par évènement du groupe
+    sizes = bounds[pair_groups + 1] - bounds[pair_groups]
+    cell_pos = np.repeat(pair_cells, sizes)
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    event_pos = order[np.repeat(bounds[pair_groups], sizes) + offsets]
+
+    cells_coord = np.array([h3.h3_to_geo(cell) for cell in cells], dtype='float64').reshape(-1, 2)
+    ev_lat = events['latitude'].to_numpy(dtype='float64')[event_pos]
+    ev_lng = events['longitude'].to_numpy(dtype='float64')[event_pos]
+    d = harvesine(cells_coord[cell_pos, 1], cells_coord[cell_pos, 0], ev_lng, ev_lat)
+
+    sort = np.lexsort((event_pos, cell_pos))
+    return pd.DataFrame({'cell': np.array(cells, dtype=object)[cell_pos[sort]],
+                         'event': event_pos[sort],
+                         'wd': wd(d[sort])})
+
+
+def ring_events(events, attack_type, origin, distances):
+    """
+    Evènements de type attack_type du 2-ring de origin, et leurs poids wd.
+    """
+    pairs = distances.loc[distances['cell'] == origin]
+    c_events = events.iloc[pairs['event'].to_numpy()]
+    is_type = (c_events['type'] == attack_type).to_numpy()
 
-    return distances.drop('h3', axis=1)
+    return c_events.loc[is_type].copy(), pairs['wd'].to_numpy()[is_type]
 
 
-def cell_exposure_at_t(events, attack_type, origin, date, distances):
+def cell_exposure_at_t(events, attack_type, origin, date, distances, wa_table=None):
     """
     Calcule l'exposition à date de la cellule origin aux events de type attack_type.
+    distances : voir calc_distances
+    wa_table : table des poids d'âge (voir age_weights), calculée si absente.
     """
     
-    ring = h3.k_ring(origin, 2)
-    c_events = events.loc[(events['h3'].isin(ring)) & (events['type'] == attack_type)].copy() # On copie https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html#returning-a-view-versus-a-copy
+    c_events, wd_ring = ring_events(events, attack_type, origin, distances)
 
     # Calculate wa
 
-    def calc_event_age(row):
-        return date -row['date_start']
-
-    def calc_wa(row):
-        if row['age'].days < 0:
-            # L'évènement n'a pas encore eu lieu, on ne le prend pas en compte
-            return 0
-
-        return wa(row['age'].days)
-
-    c_events['age'] = c_events.apply(calc_event_age, axis = 1, result_type='reduce')
-    c_events['wa'] = c_events.apply(calc_wa, axis = 1, result_type='reduce')
+    c_events['age'] = date - c_events['date_start']
+    ages = c_events['age'].dt.days.to_numpy()
+    if wa_table is None or ages.max(initial=0) >= len(wa_table):
+        wa_table = age_weights(ages.max(initial=0) + 1)
+    c_events['wa'] = lookup_wa(ages, wa_table)
 
-    wd_df = distances[origin].loc[(events['h3'].isin(ring)) & (events['type'] == attack_type)]
+    return np.dot(wd_ring, c_events['wa'])
 
-    return np.dot(wd_df, c_events['wa'])
 
-
-def get_exposure(events, attack_type, p: prm.Parameters, freq):
+def get_exposure(events, attack_type, p: prm.Parameters, freq, tol=None):
     """
     Calcule la matrice d'exposition des cellules des pays listés dans p.
     aux évènements de type attack_type.
@@ -206,6 +222,9 @@ def get_exposure(events, attack_type, p: prm.Parameters, freq):
         Les paramètres retenus pour la construction de events.
     freq : str or DateOffset, default ‘D’
         frequency string
+    tol : float, optionnel
+        Les évènements dont le poids wa est inférieur à tol sont ignorés.
+        Par défaut, le calcul est exact.
 
     Returns
     -------
@@ -214,67 +233,67 @@ def get_exposure(events, attack_type, p: prm.Parameters, freq):
         * En colonne : les dates
     """
 
-    cells = []
-    for country in p.countries:
-        cells += list(json_to_h3(country, p.h3_level))
+    cells = get_cells(p.countries, p.h3_level)
 
     date_range = pd.date_range(p.startdate, p.enddate, freq=freq)
 
-    exposure = pd.DataFrame(data = [[(h3, date) for date in date_range] for h3 in cells],
-                            index = cells,
-                            columns = date_range)
-
     distances = calc_distances(cells, events)
-
-    def calc_exposure(c):
-        origin, date = c[0], c[1]
-        return cell_exposure_at_t(events, attack_type, origin, date, distances)
-
-    return exposure.progress_applymap(calc_exposure)
+    n_days = max((date_range.max() - events['date_start'].min()).days + 1, 1)
+    if tol is not None:
+        n_days = min(n_days, age_horizon(tol) + 1)
+    wa_table = age_weights(n_days)
+
+    # Couples (cellule, évènement) du bon type, triés par date
+    is_type = (events['type'] == attack_type).to_numpy()[distances['event'].to_numpy()]
+    pairs = distances.loc[is_type]
+    ev_dates = events['date_start'].to_numpy()[pairs['event'].to_numpy()]
+    order = np.argsort(ev_dates, kind='stable')
+    ev_dates = ev_dates[order]
+    cell_pos = pd.Index(cells).get_indexer(pairs['cell'])[order]
+    wd_pairs = pairs['wd'].to_numpy()[order]
+
+    # Une date à la fois, toutes les cellules d'un coup. On ne garde que
+    # les évènements déjà survenus et d'âge inférieur à len(wa_table).
+    exposure = np.zeros((len(cells), len(date_range)))
+    for d, date in enumerate(date_range):
+        date = date.to_datetime64()
+        hi = np.searchsorted(ev_dates, date, side='right')
+        lo = np.searchsorted(ev_dates, date - np.timedelta64(len(wa_table) - 1, 'D'))
+        ages = (date - ev_dates[lo:hi]) // np.timedelta64(1, 'D')
+        exposure[:, d] = np.bincount(cell_pos[lo:hi], weights=wd_pairs[lo:hi] * wa_table[ages], minlength=len(cells))
+
+    return pd.DataFrame(exposure, index=cells, columns=date_range)
 
 
 def fast_get_exposure(events, attack_type, params: prm.Parameters, freq):
     # Peut-être plus rapide avec numpy
-    cells = []
-    for country in params.countries:
-        cells += list(json_to_h3(country, params.h3_level))
+    cells = get_cells(params.countries, params.h3_level)
 
     date_range = pd.date_range(params.startdate, params.enddate, freq=freq)
 
     distances = calc_distances(cells, events)
+    wa_table = age_weights((date_range.max() - events['date_start'].min()).days + 1)
 
-    exposure = np.array([[cell_exposure_at_t(events, attack_type, origin, date, distances) for date in date_range] for origin in cells])
+    exposure = np.array([[cell_exposure_at_t(events, attack_type, origin, date, distances, wa_table) for date in date_range] for origin in cells])
 
     return pd.DataFrame(data=exposure, index=cells, columns=date_range)
 
 
-def cell_exposure_at_t_with_cas(events, attack_type, origin, date, distances):
+def cell_exposure_at_t_with_cas(events, attack_type, origin, date, distances, wa_table=None):
     """
     Calcule l'exposition à date de la cellule origin aux events de type attack_type
     en prenant en compte le nombre de victimes ("cas" = casualties).
     """
     
-    ring = h3.k_ring(origin, 2)
-    c_events = events.loc[(events['h3'].isin(ring)) & (events['type'] == attack_type)].copy() # On copie https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html#returning-a-view-versus-a-copy
+    c_events, wd_df = ring_events(events, attack_type, origin, distances)
 
     # Calculate wa
 
-    def calc_event_age(row):
-        return date -row['date_start']
-
-    def calc_wa(row):
-        if row['age'].days < 0:
-            # L'évènement n'a pas encore eu lieu, on ne le prend pas en compte
-            return 0
-
-        return wa(row['age'].days)
-
-    c_events['age'] = c_events.apply(calc_event_age, axis = 1, result_type='reduce')
-    c_events['wa'] = c_events.apply(calc_wa, axis = 1, result_type='reduce')
-
-    # Fetch wd
-
-    wd_df = distances[origin].loc[(events['h3'].isin(ring)) & (events['type'] == attack_type)]
+    c_events['age'] = date - c_events['date_start']
+    ages = c_events['age'].dt.days.to_numpy()
+    if wa_table is None or ages.max(initial=0) >= len(wa_table):
+        wa_table = age_weights(ages.max(initial=0) + 1)
+    c_events['wa'] = lookup_wa(ages, wa_table)
 
     # Calculate wcas
 
@@ -296,9 +315,7 @@ def get_exposure_with_cas(events, attack_type, p: prm.Parameters, freq):
     aux évènements de type attack_type, en prenant en compte le nombre de victimes.
     """
 
-    cells = []
-    for country in p.countries:
-        cells += list(json_to_h3(country, p.h3_level))
+    cells = get_cells(p.countries, p.h3_level)
 
     date_range = pd.date_range(p.startdate, p.enddate, freq=freq)
 
@@ -307,10 +324,11 @@ def get_exposure_with_cas(events, attack_type, p: prm.Parameters, freq):
                             columns = date_range)
 
     distances = calc_distances(cells, events)
+    wa_table = age_weights((date_range.max() - events['date_start'].min()).days + 1)
 
     def calc_exposure(c):
         origin, date = c[0], c[1]
-        return cell_exposure_at_t_with_cas(events, attack_type, origin, date, distances)
+        return cell_exposure_at_t_with_cas(events, attack_type, origin, date, distances, wa_table)
 
     return exposure.progress_applymap(calc_exposure)
 
@@ -1,60 +1,6 @@
-import numpy as np, pandas as pd, json, h3, geopandas, matplotlib.pyplot as plt, parameters as prm
-from numba import njit
-from shapely.geometry import Polygon, Point
-
-
-########################
-# Cadrillage d'un pays #
-########################
-
-# GeoJSON : https://geojson-maps.ash.ms/
-
-def swap_lng_lat(geoJSON_Polygon):
-    # Les coordonnées des points du geoJSON sont dans l'ordre (lng, lat)
-    # mais h3.polyfills() prend des coordonnées dans l'ordre (lat, lng).
-    # Il faut donc les échanger dans le JSON.
-    geoJSON_Polygon['coordinates'][0] = [[coord[1], coord[0]] for coord in geoJSON_Polygon['coordinates'][0]]
-
-
-def json_to_h3(country, res):
-    """
-    Remplit une surface avec des hexagones.
-
-    Parameters
-    ----------
-    country : str
-    res : int
-        Résolution H3, entre 1 et 16
-
-    Returns
-    -------
-    Liste des identifiants des cellules H3 remplissant la surface.
-    """
-    path = f"../GeoJSONs/{country}.geo.json"
-    fObj = open(path)
-
-    s = json.load(fObj)
-    s = s['features'][0]['geometry']
-    swap_lng_lat(s)
-    return h3.polyfill(s, res = res)
-
-
-def add_geometry(row):
-    points = h3.h3_to_geo_boundary(row['h3'], True)
-    return Polygon(points)
-
-
-def country_grid(country, res):
-    """
-    Crée un GeoDataFrame contenant les Polygons de toutes les cellules remplissant le pays.
-    """
-    h3 = json_to_h3(country, res)
-
-    df = pd.DataFrame(h3, columns = ['h3'])
-
-    df['geometry'] = df.apply(add_geometry, axis=1)
-    
-    return gpd.GeoDataFrame(df, crs='EPSG:4326')
+import os, numpy as np, pandas as pd, h3, parameters as prm, observation, grid
+from numba import njit, prange, set_num_threads
+from h3.api import basic_int as h3_int
 
 
 ###########################
@@ -78,21 +24,76 @@ def harvesine(lng1, lat1, lng2, lat2):
     b = np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2)**2
     return 2 * r * np.arcsin(np.sqrt(a + b))
 
-@njit
-def calc_distances(cells_coord, events_coord, is_in_ring):
+def get_incidence(cells, events_h3):
     """
-    Calcule la matrice de distance cellules-évènements.
+    Construit la structure creuse (format CSR) reliant chaque cellule
+    aux évènements situés dans son 2-ring.
+
+    Les évènements sont regroupés par cellule H3, et le 2-ring de chacune
+    de ces cellules n'est développé qu'une seule fois. On n'a ainsi jamais
+    à construire de matrice dense cellules x évènements.
+
+    Returns
+    -------
+    indptr : ndarray de taille (n_cells + 1,)
+        Les évènements de la cellule i sont indices[indptr[i]:indptr[i+1]].
+    indices : ndarray
+        Indices des évènements, triés pour chaque cellule.
     """
-    res = np.zeros((len(cells_coord), len(events_coord)), dtype='float64')
+    # Les évènements sont repérés par des identifiants H3 entiers (voir precleaning.grid)
+    cell_index = {h3.string_to_h3(cell): i for i, cell in enumerate(cells)}
+
+    codes, uniques = pd.factorize(events_h3)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+    rows, cols = [], []
+    for u, h in enumerate(uniques):
+        group = order[bounds[u]:bounds[u+1]]
+        for c in h3_int.k_ring(int(h), 2):
+            if c in cell_index:
+                rows.append(np.full(len(group), cell_index[c]))
+                cols.append(group)
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype='int64')
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype='int64')
+
+    order = np.lexsort((cols, rows))
+    indices = cols[order].astype('int64')
+    indptr = np.zeros(len(cells) + 1, dtype='int64')
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(cells)))
+
+    return indptr, indices
+
+
+@njit(cache=True)
+def calc_distances(cells_coord, events_coord, indptr, indices):
+    """
+    Calcule les distances cellules-évènements, pour les seuls couples
+    non nuls de la structure creuse (même ordre que indices).
+    """
+    res = np.zeros(len(indices), dtype='float64')
     for i in range(len(cells_coord)):
-        for j in range(len(events_coord)):
-            if is_in_ring[i,j]: # if events_coord[j] is in ring(cells_coord[i])
-                lat1, lng1 = cells_coord[i][0], cells_coord[i][1]
-                lat2, lng2 = events_coord[j][0], events_coord[j][1]
-                res[i,j] = harvesine(lng1, lat1, lng2, lat2)
+        for k in range(indptr[i], indptr[i+1]):
+            j = indices[k]
+            lat1, lng1 = cells_coord[i][0], cells_coord[i][1]
+            lat2, lng2 = events_coord[j][0], events_coord[j][1]
+            res[k] = harvesine(lng1, lat1, lng2, lat2)
 
     return res
 
+# Les évènements de chaque cellule sont rangés par date : les noyaux trouvent
+# alors par recherche dichotomique (np.searchsorted) ceux qui ont déjà eu lieu
+# et qui ne sont pas trop anciens, sans parcourir les autres.
+
+def sort_incidence_by_date(indptr, indices, distances, events_days):
+    """
+    Trie les évènements de chaque cellule par date (et par indice, à date égale).
+    """
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    order = np.lexsort((indices, events_days[indices], rows))
+    return indices[order], distances[order]
+
 # ------------------------------------------------------------------------
 
 @njit
@@ -117,39 +118,264 @@ def wa(x):
     else:
         return logistic(kappa_a, gamma_a, x)
 
+# Les dates des évènements et celles de date_range tombent toutes à minuit :
+# l'âge d'un évènement est donc toujours un nombre entier de jours. Plutôt que
+# de recalculer la logistique pour chaque triplet (cellule, date, évènement),
+# on tabule wa une fois pour toutes, pour chaque âge possible en jours.
+
+day = 86400 # nb de secondes dans un jour
+
+def age_horizon(tol):
+    """
+    Age (en jours) au-delà duquel le poids wa d'un évènement est inférieur à tol :
+    wa(x) < tol dès que gamma_a * x > kappa_a + log(1/tol - 1).
+    """
+    return int(np.ceil((kappa_a + np.log(1/tol - 1)) / (gamma_a * day)))
+
+def age_weights(events_days, dates_days, tol=None):
+    """
+    Table des poids wa, indexée par l'âge en jours (de 0 à l'âge maximal possible).
+
+    Les noyaux ne regardent que les évènements dont l'âge a une entrée dans la
+    table : avec tol, la table s'arrête à age_horizon(tol), et les évènements
+    plus anciens (de poids wa < tol) sont ignorés. Sans tol, le calcul est exact.
+    """
+    first_day = events_days.min() if len(events_days) else dates_days.max(initial=0)
+    n_days = max(dates_days.max(initial=0) - first_day, 0) + 1
+    if tol is not None:
+        n_days = min(n_days, age_horizon(tol) + 1)
+    return logistic(kappa_a, gamma_a, np.arange(n_days) * float(day))
+
 # ------------------------------------------------------------------------
 
 @njit
-def cell_exposure_at_t(events_dates, cell_index, date, is_in_ring, distances):
+def cell_exposure_at_t(pair_days, cell_index, date, indptr, distances, wa_table):
     """
-    Calcule l'exposition d'une cellule à une date donnée.
-    """
-    n_events = is_in_ring.shape[1]
+    Calcule l'exposition d'une cellule à une date donnée (dates en jours).
 
-    wa_array = np.zeros(n_events, dtype='float64')
-    wd_array = np.zeros(n_events, dtype='float64')
+    pair_days : dates des évènements de chaque cellule, triées (voir sort_incidence_by_date)
+    Seuls les évènements de la fenêtre [date - horizon, date] sont parcourus,
+    où horizon = len(wa_table) - 1 (voir age_weights).
+    """
+    start, end = indptr[cell_index], indptr[cell_index+1]
+    days = pair_days[start:end]
+    # Les évènements suivants n'ont pas encore eu lieu, les précédents sont trop anciens
+    hi = start + np.searchsorted(days, date, side='right')
+    lo = start + np.searchsorted(days, date - (len(wa_table) - 1))
 
-    for j in range(n_events):
-        if is_in_ring[cell_index, j]:
-            age = date - events_dates[j]
-            wa_array[j] = wa(age)
-            wd_array[j] = wd(distances[cell_index, j])
+    res = 0.
+    for k in range(lo, hi):
+        res += wd(distances[k]) * wa_table[date - pair_days[k]]
 
-    return np.dot(wd_array, wa_array)
+    return res
 
-def get_exposure_raw(events_dates, is_in_ring, distances, date_range):
+@njit(parallel=True, cache=True)
+def get_exposure_raw(events_days, indptr, indices, distances, dates_days, wa_table):
     """
     Calcule un tableau numpy d'exposition des cellules sur une période.
     "raw" car get_exposure est déjà pris.
+
+    Les cellules sont réparties entre les threads (voir set_num_threads),
+    et le code compilé est mis en cache sur le disque. Les évènements de chaque
+    cellule doivent être triés par date (voir sort_incidence_by_date).
+    """
+
+    n_cells = len(indptr) - 1
+    n_dates = len(dates_days)
+    exposure = np.zeros((n_cells, n_dates), dtype='float64')
+
+    # indptr peut ne couvrir qu'une partie de indices (paquets de get_observation_fused)
+    pair_days = events_days[indices]
+
+    for i in prange(n_cells):
+        for d in range(n_dates):
+            exposure[i][d] = cell_exposure_at_t(pair_days, i, dates_days[d], indptr, distances, wa_table)
+
+    return exposure
+
+@njit(parallel=True, cache=True)
+def get_exposures_raw(events_days, events_types, n_types, indptr, indices, distances, dates_days, wa_table):
+    """
+    Calcule en un seul passage l'exposition des cellules aux évènements de
+    chaque type : tableau de taille (n_types, n_cells, n_dates).
+
+    events_types : numéro (de 0 à n_types - 1) du type de chaque évènement.
+    La structure d'incidence porte sur les évènements de tous les types,
+    triés par date dans chaque cellule (voir prepare_exposures).
+    """
+
+    n_cells = len(indptr) - 1
+    n_dates = len(dates_days)
+    exposure = np.zeros((n_types, n_cells, n_dates), dtype='float64')
+
+    pair_days = events_days[indices]
+    horizon = len(wa_table) - 1
+
+    for i in prange(n_cells):
+        start, end = indptr[i], indptr[i+1]
+        days = pair_days[start:end]
+        for d in range(n_dates):
+            date = dates_days[d]
+            hi = start + np.searchsorted(days, date, side='right')
+            lo = start + np.searchsorted(days, date - horizon)
+            for k in range(lo, hi):
+                exposure[events_types[indices[k]], i, d] += wd(distances[k]) * wa_table[date - pair_days[k]]
+
+    return exposure
+
+# ------------------------------------------------------------------------
+
+# Version "évènement par évènement" : au lieu de parcourir les évènements
+# voisins de chaque cellule à chaque date, chaque évènement ajoute sa
+# contribution wd x wa aux (au plus 19) cellules de son 2-ring, pour
+# toutes les dates qui le suivent.
+
+def transpose_incidence(indptr, indices, distances, n_events):
+    """
+    Transpose la structure creuse cellules -> évènements
+    en une structure évènements -> cellules.
+    """
+    n_cells = len(indptr) - 1
+    rows = np.repeat(np.arange(n_cells), np.diff(indptr))
+
+    order = np.argsort(indices, kind='stable')
+    ev_indptr = np.zeros(n_events + 1, dtype='int64')
+    ev_indptr[1:] = np.cumsum(np.bincount(indices, minlength=n_events))
+
+    return ev_indptr, rows[order], distances[order]
+
+@njit(cache=True)
+def get_exposure_scatter(events_days, ev_indptr, ev_cells, ev_distances, dates_days, wa_table, n_cells):
     """
+    Calcule le tableau d'exposition en dispersant la contribution de chaque évènement.
+    dates_days doit être trié.
+    """
+    n_events = len(ev_indptr) - 1
+    n_dates = len(dates_days)
+    exposure = np.zeros((n_cells, n_dates), dtype='float64')
+    horizon = len(wa_table) - 1
+
+    for j in range(n_events):
+        # Dates auxquelles l'évènement a eu lieu, et n'est pas trop ancien
+        first = np.searchsorted(dates_days, events_days[j])
+        last = np.searchsorted(dates_days, events_days[j] + horizon, side='right')
+        for d in range(first, last):
+            a = wa_table[dates_days[d] - events_days[j]]
+            for k in range(ev_indptr[j], ev_indptr[j+1]):
+                exposure[ev_cells[k], d] += wd(ev_distances[k]) * a
+
+    return exposure
+
+@njit(cache=True)
+def mean_exposure(events_days, indptr, indices, distances, dates_days, wa_table, n_cells=0):
+    """
+    Calcule l'exposition moyenne des cellules à chaque date, sans construire le tableau d'exposition.
+
+    L'exposition totale à une date est la somme, sur les évènements, de wa x (somme des wd
+    des cellules de leur 2-ring) : le coût ne dépend que du nombre d'évènements et de dates.
+
+    n_cells : nombre de cellules de la grille complète, si les lignes sont celles
+    d'une grille adaptative (par défaut, le nombre de lignes).
+    """
+    if n_cells == 0:
+        n_cells = len(indptr) - 1
+    n_dates = len(dates_days)
+
+    weights = np.zeros(len(events_days), dtype='float64')
+    for k in range(len(indices)):
+        weights[indices[k]] += wd(distances[k])
+
+    horizon = len(wa_table) - 1
+    means = np.zeros(n_dates, dtype='float64')
+    for j in range(len(events_days)):
+        first = np.searchsorted(dates_days, events_days[j])
+        last = np.searchsorted(dates_days, events_days[j] + horizon, side='right')
+        for d in range(first, last):
+            means[d] += weights[j] * wa_table[dates_days[d] - events_days[j]]
+
+    return means / n_cells
+
+# ------------------------------------------------------------------------
+
+# Version pondérée par le nombre de victimes (voir exposure.cell_exposure_at_t_with_cas).
+# Pour chaque cellule, les évènements voisins sont parcourus dans l'ordre de leurs
+# dates : la moyenne des victimes des 90 derniers jours est mise à jour de proche
+# en proche d'une date à la suivante (fenêtre glissante), au lieu d'être recalculée
+# pour chaque évènement.
+
+@njit
+def wcas(mean, x):
+    # Paramètres à discuter (mêmes valeurs que exposure.wcas)
+    return 1 / (1 + np.exp(-0.5*(x-mean)))
 
-    n_cells, n_events = distances.shape
-    n_dates = len(date_range)
+@njit(parallel=True, cache=True)
+def get_exposure_with_cas_raw(events_days, fatalities, indptr, indices, distances, dates_days, wa_table, window=90):
+    """
+    Calcule le tableau d'exposition pondérée par le nombre de victimes.
+
+    Les évènements de chaque cellule doivent être triés par date (voir
+    sort_incidence_by_date), et dates_days doit être trié. Les évènements plus
+    anciens que l'horizon de wa_table (voir age_weights) ne comptent que dans la
+    moyenne des wcas. Mêmes règles que
+    exposure.cell_exposure_at_t_with_cas :
+    * mean : moyenne des victimes (NaN ignorés) des évènements voisins âgés de 0 à window jours,
+    * chaque évènement voisin est pondéré par wd x wa x wcas(mean, victimes),
+    * les wcas manquants (victimes inconnues) valent la moyenne des autres,
+    * NaN s'il y a des évènements voisins mais aucun récent (mean indéfinie).
+    """
+    n_cells = len(indptr) - 1
+    n_dates = len(dates_days)
     exposure = np.zeros((n_cells, n_dates), dtype='float64')
+    pair_days = events_days[indices]
+
+    for i in prange(n_cells):
+        start, end = indptr[i], indptr[i+1]
+        if start == end:
+            continue
+
+        # Fenêtre [lo, hi) des évènements âgés de 0 à window jours
+        lo, hi = start, start
+        total, count = 0., 0
 
-    for i in range(n_cells):
         for d in range(n_dates):
-            exposure[i][d] = cell_exposure_at_t(events_dates, i, date_range[d], is_in_ring, distances)
+            date = dates_days[d]
+            while hi < end and events_days[indices[hi]] <= date:
+                f = fatalities[indices[hi]]
+                if not np.isnan(f):
+                    total += f
+                    count += 1
+                hi += 1
+            while lo < hi and events_days[indices[lo]] < date - window:
+                f = fatalities[indices[lo]]
+                if not np.isnan(f):
+                    total -= f
+                    count -= 1
+                lo += 1
+
+            if count == 0:
+                exposure[i, d] = np.nan
+                continue
+            mean = total / count
+
+            # Valeur des wcas manquants : moyenne des autres
+            w_sum, w_count = 0., 0
+            for k in range(start, end):
+                f = fatalities[indices[k]]
+                if not np.isnan(f):
+                    w_sum += wcas(mean, f)
+                    w_count += 1
+            fill = w_sum / w_count
+
+            # Les évènements suivants n'ont pas encore eu lieu, ceux d'avant
+            # first sont plus anciens que l'horizon de wa_table (voir age_weights)
+            first = start + np.searchsorted(pair_days[start:end], date - (len(wa_table) - 1))
+
+            res = 0.
+            for k in range(first, hi):
+                f = fatalities[indices[k]]
+                w = fill if np.isnan(f) else wcas(mean, f)
+                res += wd(distances[k]) * wa_table[date - events_days[indices[k]]] * w
+            exposure[i, d] = res
 
     return exposure
 
@@ -158,35 +384,341 @@ def get_exposure_raw(events_dates, is_in_ring, distances, date_range):
 # Il faut faire le lien entre les "fonctions Numba" ci-dessus
 # et le design de code de exposure.py
 
-def get_exposure(events, attack_type, p, freq):
+def get_cells(p, events=None):
+    """
+    Liste des cellules H3 des pays listés dans p, et leurs centres (lat, lng).
+
+    Si events est renseigné, la grille est adaptative (voir grid.compact_grid) :
+    pleine résolution autour des évènements, cellules parentes ailleurs.
+    """
+    ids, cells_coord, _ = grid.get_grid(p.countries, p.h3_level)
+    if events is not None:
+        ids, cells_coord = grid.compact_grid(ids, cells_coord, events["h3"].to_numpy())
+    return [h3.h3_to_string(int(i)) for i in ids], cells_coord
+
+def get_date_range(p, freq):
+    """
+    Dates de la période, en secondes depuis le 1er janvier 1970.
+    """
+    date_range = pd.date_range(p.startdate, p.enddate, freq=freq)
+    return ((date_range - pd.Timestamp("1970-01-01")) // pd.Timedelta("1s")).to_numpy()
+
+def prepare_exposure(events, attack_type, cells, cells_coord, date_range, tol=None):
     """
+    Prépare les entrées des noyaux d'exposition pour les évènements de type attack_type.
+    Les évènements de chaque cellule sont triés par date ; tol : voir age_weights.
+
+    Returns
+    -------
+    events_days, indptr, indices, distances, dates_days, wa_table
     """
+    events_days, _, indptr, indices, distances, dates_days, wa_table = prepare_exposures(events, [attack_type], cells, cells_coord, date_range, tol)
+    return events_days, indptr, indices, distances, dates_days, wa_table
 
-    cells = []
-    for country in p.countries:
-        cells += list(json_to_h3(country, p.h3_level))
+def prepare_exposures(events, types, cells, cells_coord, date_range, tol=None):
+    """
+    Comme prepare_exposure, pour les évènements de tous les types de la liste types :
+    la structure d'incidence et les distances ne sont calculées qu'une fois.
 
-    cells_coord = np.array([[h3.h3_to_geo(c)[0], h3.h3_to_geo(c)[1]] for c in cells], dtype='float64')
-    events_of_type = events[events["type"] == attack_type]
+    Returns
+    -------
+    events_days, events_types, indptr, indices, distances, dates_days, wa_table
+        events_types : position du type de chaque évènement dans types
+    """
+    events_of_type = events[events["type"].isin(types)]
+    events_types = pd.Categorical(events_of_type["type"], categories=types).codes.astype('int64')
     events_coord = events_of_type[["latitude", "longitude"]].to_numpy(dtype='float64')
 
     events_h3 = events_of_type["h3"].to_numpy()
-    rings = np.array([list(h3.k_ring(str(cell), 2)) for cell in cells], dtype='object')
-    is_in_ring = np.array([np.isin(events_h3, ring) for ring in rings])
+    indptr, indices = get_incidence(cells, events_h3)
 
-    date_range = pd.date_range(p.startdate, p.enddate, freq=freq)
-    date_range = ((date_range - pd.Timestamp("1970-01-01")) // pd.Timedelta("1s")).to_numpy()
+    events_dates = ((events_of_type["date_start"] - pd.Timestamp("1970-01-01")) // pd.Timedelta("1s")).to_numpy()
+
+    distances = calc_distances(cells_coord, events_coord, indptr, indices)
+
+    events_days = events_dates // day
+    dates_days = date_range // day
+    wa_table = age_weights(events_days, dates_days, tol)
 
-    events_dates = ((events["date_start"] - pd.Timestamp("1970-01-01")) // pd.Timedelta("1s")).to_numpy()
+    indices, distances = sort_incidence_by_date(indptr, indices, distances, events_days)
 
-    distances = calc_distances(cells_coord, events_coord, is_in_ring)
+    return events_days, events_types, indptr, indices, distances, dates_days, wa_table
 
-    g = get_exposure_raw(events_dates, is_in_ring, distances, date_range)
+def exposure_kernel(events_days, indptr, indices, distances, dates_days, wa_table, engine="gather"):
+    """
+    Matrice d'exposition (cellules x dates) calculée par le noyau engine.
+    """
+    if engine == "gather":
+        return get_exposure_raw(events_days, indptr, indices, distances, dates_days, wa_table)
+    elif engine == "scatter":
+        ev_indptr, ev_cells, ev_distances = transpose_incidence(indptr, indices, distances, len(events_days))
+        return get_exposure_scatter(events_days, ev_indptr, ev_cells, ev_distances, dates_days, wa_table, len(indptr) - 1)
+    else:
+        raise ValueError(f"Unknown engine : {engine}")
+
+def get_exposure(events, attack_type, p, freq, engine="gather", adaptive=False, tol=None, path=None):
+    """
+    Calcule la matrice d'exposition des cellules des pays listés dans p
+    aux évènements de type attack_type.
+
+    engine : "gather" (cellule par cellule) ou "scatter" (évènement par évènement,
+    plus rapide quand il y a beaucoup de cellules sans évènement à proximité)
+    adaptive : grille adaptative (voir get_cells). Les lignes des cellules parentes
+    sont nulles ; grid.uncompact_df redonne la matrice de la grille complète.
+    tol : les évènements dont le poids wa est devenu inférieur à tol sont ignorés
+    (voir age_weights). Par défaut (None), le calcul est exact.
+    path : fichier CSV où la matrice est enregistrée (voir update_exposure). S'il
+    existe déjà, seules les nouvelles dates et les cellules touchées par des
+    évènements ajoutés, modifiés ou supprimés depuis le dernier calcul sont calculées.
+    """
+
+    if p.n_threads is not None:
+        set_num_threads(p.n_threads)
+
+    # Les évènements de tous les types fixent la grille : elle est la même pour chaque type
+    cells, cells_coord = get_cells(p, events if adaptive else None)
+    date_range = get_date_range(p, freq)
+
+    events_days, indptr, indices, distances, dates_days, wa_table = prepare_exposure(events, attack_type, cells, cells_coord, date_range, tol)
+
+    if path is not None:
+        return update_exposure(events[events["type"] == attack_type], cells, date_range, path,
+                               events_days, indptr, indices, distances, dates_days, wa_table, engine)
+
+    g = exposure_kernel(events_days, indptr, indices, distances, dates_days, wa_table, engine)
 
     return pd.DataFrame(g, index=cells, columns=pd.to_datetime(date_range, unit="s"))
 
 # ------------------------------------------------------------------------
 
+# Mise à jour incrémentale : chaque mois, les bases ajoutent quelques évènements
+# et quelques dates ; l'exposition des dates déjà calculées ne change que dans
+# les cellules proches des évènements ajoutés, modifiés ou supprimés, et
+# seulement à partir de leur date. La matrice est enregistrée avec la liste des
+# évènements utilisés (fichier "_events.csv" à côté), que l'on compare à la
+# nouvelle par identifiant (colonne event_id, voir precleaning).
+
+def events_path(path):
+    return os.path.splitext(path)[0] + "_events.csv"
+
+def events_snapshot(events_of_type):
+    """
+    Champs des évènements dont dépend l'exposition, indexés par event_id.
+    """
+    return pd.DataFrame({
+        "days": ((events_of_type["date_start"] - pd.Timestamp("1970-01-01")) // pd.Timedelta("1s")).to_numpy() // day,
+        "latitude": events_of_type["latitude"].to_numpy(dtype='float64'),
+        "longitude": events_of_type["longitude"].to_numpy(dtype='float64'),
+        "h3": events_of_type["h3"].to_numpy().astype('int64'),
+    }, index=pd.Index(events_of_type["event_id"].to_numpy(), name="event_id"))
+
+def stale_events(old, new):
+    """
+    Évènements ajoutés, supprimés ou modifiés entre les instantanés old et new
+    (les modifiés y sont deux fois : ancienne et nouvelle version).
+    """
+    both = old.index.intersection(new.index)
+    changed = both[(old.loc[both] != new.loc[both]).any(axis=1).to_numpy()]
+    return pd.concat([old.loc[old.index.difference(new.index).union(changed)],
+                      new.loc[new.index.difference(old.index).union(changed)]])
+
+def select_rows(indptr, indices, distances, rows):
+    """
+    Lignes rows de la matrice d'incidence (CSR).
+    """
+    counts = np.diff(indptr)[rows]
+    sub_indptr = np.zeros(len(rows) + 1, dtype=indptr.dtype)
+    np.cumsum(counts, out=sub_indptr[1:])
+    take = np.repeat(indptr[rows] - sub_indptr[:-1], counts) + np.arange(sub_indptr[-1])
+    return sub_indptr, indices[take], distances[take]
+
+def write_atomic(df, path):
+    # Écriture dans un fichier temporaire puis renommage : un calcul interrompu
+    # ne laisse pas de fichier tronqué
+    tmp = path + ".tmp"
+    df.to_csv(tmp)
+    os.replace(tmp, path)
+
+def update_exposure(events_of_type, cells, date_range, path, events_days, indptr, indices, distances, dates_days, wa_table, engine="gather"):
+    """
+    Met à jour la matrice d'exposition enregistrée dans path, et l'y réécrit.
+
+    Les colonnes des dates absentes du fichier sont calculées pour toutes les
+    cellules ; celles des dates déjà calculées ne le sont à nouveau que pour
+    les cellules dont le 2-ring contient un évènement ajouté, modifié ou
+    supprimé, et à partir de la date du plus ancien d'entre eux. Si le fichier
+    n'existe pas, ou si la grille a changé, tout est calculé.
+
+    Le fichier doit avoir été écrit avec les mêmes freq, tol et engine.
+
+    Parameters
+    ----------
+    events_of_type : DataFrame des évènements du type voulu
+    cells, date_range : grille et dates (en secondes) de la matrice
+    path : str
+    events_days, ..., wa_table : sorties de prepare_exposure
+    engine : voir get_exposure
+
+    Returns
+    -------
+    DataFrame (cellules x dates)
+    """
+    new = events_snapshot(events_of_type)
+    columns = pd.to_datetime(date_range, unit="s")
+
+    old_E = None
+    if os.path.exists(path) and os.path.exists(events_path(path)):
+        old_E = pd.read_csv(path, index_col=0, float_precision="round_trip")
+        if list(old_E.index) != list(cells):
+            old_E = None
+
+    if old_E is None:
+        g = exposure_kernel(events_days, indptr, indices, distances, dates_days, wa_table, engine)
+    else:
+        old_E.columns = pd.to_datetime(old_E.columns)
+        known = columns.isin(old_E.columns)
+
+        g = np.empty((len(cells), len(dates_days)), dtype='float64')
+        g[:, known] = old_E[columns[known]].to_numpy()
+        if (~known).any():
+            g[:, ~known] = exposure_kernel(events_days, indptr, indices, distances, dates_days[~known], wa_table, engine)
+
+        old = pd.read_csv(events_path(path), index_col="event_id", float_precision="round_trip")
+        stale = stale_events(old, new)
+        if len(stale) > 0:
+            # Avant la date du plus ancien évènement concerné, rien ne change
+            redo = known & (dates_days >= stale["days"].min())
+            stale_indptr, _ = get_incidence(cells, stale["h3"].to_numpy().astype('uint64'))
+            rows = np.flatnonzero(np.diff(stale_indptr))
+            if redo.any() and len(rows) > 0:
+                sub = select_rows(indptr, indices, distances, rows)
+                g[np.ix_(rows, redo)] = exposure_kernel(events_days, *sub, dates_days[redo], wa_table, engine)
+
+    E = pd.DataFrame(g, index=cells, columns=columns)
+    write_atomic(E, path)
+    write_atomic(new, events_path(path))
+    return E
+
+def get_exposures(events, types, p, freq, adaptive=False, tol=None):
+    """
+    Calcule les matrices d'exposition aux évènements de chacun des types de la
+    liste types (par exemple ["conventional", "terrorism"]), en un seul passage :
+    grille, structure d'incidence et distances sont partagées entre les types.
+
+    adaptive, tol : voir get_exposure
+
+    Returns
+    -------
+    dict {type : DataFrame (cellules x dates)}
+    """
+
+    if p.n_threads is not None:
+        set_num_threads(p.n_threads)
+
+    cells, cells_coord = get_cells(p, events if adaptive else None)
+    date_range = get_date_range(p, freq)
+    columns = pd.to_datetime(date_range, unit="s")
+
+    events_days, events_types, indptr, indices, distances, dates_days, wa_table = prepare_exposures(events, types, cells, cells_coord, date_range, tol)
+    g = get_exposures_raw(events_days, events_types, len(types), indptr, indices, distances, dates_days, wa_table)
+
+    return {attack_type: pd.DataFrame(g[k], index=cells, columns=columns) for k, attack_type in enumerate(types)}
+
+def get_exposure_with_cas(events, attack_type, p, freq, adaptive=False, tol=None):
+    """
+    Calcule la matrice d'exposition des cellules des pays listés dans p aux
+    évènements de type attack_type, en prenant en compte le nombre de victimes
+    (même modèle que exposure.get_exposure_with_cas).
+
+    adaptive, tol : voir get_exposure
+    """
+
+    if p.n_threads is not None:
+        set_num_threads(p.n_threads)
+
+    cells, cells_coord = get_cells(p, events if adaptive else None)
+    date_range = get_date_range(p, freq)
+
+    events_days, indptr, indices, distances, dates_days, wa_table = prepare_exposure(events, attack_type, cells, cells_coord, date_range, tol)
+    fatalities = events.loc[events["type"] == attack_type, "fatalities"].to_numpy(dtype='float64')
+
+    g = get_exposure_with_cas_raw(events_days, fatalities, indptr, indices, distances, dates_days, wa_table)
+
+    return pd.DataFrame(g, index=cells, columns=pd.to_datetime(date_range, unit="s"))
+
+def get_observation_fused(events, p, freq, m, xs, block_size=5000, exposure_paths=None, adaptive=False, tol=None):
+    """
+    Calcule directement la matrice d'observations, sans garder en mémoire
+    les matrices d'exposition Ec, Et ni les matrices de probabilités C, T.
+
+    Un premier passage peu coûteux donne l'exposition moyenne de chaque date
+    (le paramètre des lois de Poisson de observation.get_probabilities). Les
+    cellules sont ensuite traitées par paquets de block_size : exposition,
+    probabilités puis observations. La mémoire dépend donc de block_size,
+    et non de la taille de la grille.
+
+    Parameters
+    ----------
+    m, xs : voir observation.get_observation
+    exposure_paths : dict, optionnel
+        Chemins des .csv où écrire, paquet par paquet, les matrices d'exposition
+        de chaque type ("conventional", "terrorism").
+    adaptive : grille adaptative (voir get_exposure). Les matrices d'exposition
+        écrites dans exposure_paths sont remises à la pleine résolution.
+    tol : voir get_exposure
+
+    Returns
+    -------
+    O : DataFrame d'entiers int8 (cellules en ligne, dates en colonne)
+    """
+
+    if p.n_threads is not None:
+        set_num_threads(p.n_threads)
+
+    cells, cells_coord = get_cells(p, events if adaptive else None)
+    date_range = get_date_range(p, freq)
+    columns = pd.to_datetime(date_range, unit="s")
+
+    # Les moyennes portent sur toutes les cellules de la grille complète
+    n_cells = int(grid.cell_weights(cells, p.h3_level).sum())
+
+    # Une seule structure d'incidence pour les deux types
+    types = ["conventional", "terrorism"]
+    events_days, events_types, indptr, indices, distances, dates_days, wa_table = prepare_exposures(events, types, cells, cells_coord, date_range, tol)
+
+    means = {}
+    for k, attack_type in enumerate(types):
+        # Les évènements de l'autre type ne sont pas dans les paires gardées : leur poids est nul
+        keep = events_types[indices] == k
+        means[attack_type] = mean_exposure(events_days, indptr, indices[keep], distances[keep], dates_days, wa_table, n_cells)
+
+    O = np.zeros((len(cells), len(date_range)), dtype='int8')
+
+    for start in range(0, len(cells), block_size):
+        end = min(start + block_size, len(cells))
+
+        # indptr[start:end+1] garde des positions absolues dans indices et distances
+        g = get_exposures_raw(events_days, events_types, len(types), indptr[start:end+1], indices, distances, dates_days, wa_table)
+
+        E = {}
+        for k, attack_type in enumerate(types):
+            E[attack_type] = g[k]
+
+            if exposure_paths is not None:
+                E_df = pd.DataFrame(E[attack_type], index=cells[start:end], columns=columns)
+                if adaptive:
+                    E_df = grid.uncompact_df(E_df, p.h3_level)
+                E_df.to_csv(
+                    exposure_paths[attack_type], mode='w' if start == 0 else 'a', header=(start == 0))
+
+        C = observation.probabilities(E["conventional"], means["conventional"])
+        T = observation.probabilities(E["terrorism"], means["terrorism"])
+        O[start:end] = observation.observations(E["terrorism"], E["conventional"], C, T, m, xs)
+
+    return pd.DataFrame(O, index=cells, columns=columns)
+
+# ------------------------------------------------------------------------
+
 def main():
     import precleaning as pcl
     import time
@@ -0,0 +1,320 @@
+import os
+import json
+import hashlib
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import h3
+from h3.api import basic_int as h3_int
+import shapely
+
+
+###############################
+# Cadrillage H3 d'un pays     #
+###############################
+
+# GeoJSON : https://geojson-maps.ash.ms/
+
+# Les grilles sont longues à calculer (lecture du GeoJSON, h3.polyfill, centres
+# et contours de chaque cellule) : on les enregistre une fois pour toutes dans
+# ../grids/, sous une clé (pays, résolution, hash du GeoJSON). Si le GeoJSON
+# change, la clé change et la grille est recalculée. grid_version est à
+# incrémenter quand la façon de remplir les pays change.
+
+grid_version = 2
+geojson_dir = "../GeoJSONs/"
+grid_dir = "../grids/"
+
+# Grilles déjà chargées pendant l'exécution
+_grids = {}
+
+
+def geojson_path(country):
+    return os.path.join(geojson_dir, f"{country}.geo.json")
+
+
+def geojson_hash(country):
+    """
+    Empreinte du fichier GeoJSON du pays (16 caractères hexadécimaux).
+    """
+    with open(geojson_path(country), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def polygons(geometry):
+    """
+    Liste des polygones (contour extérieur puis trous, au format GeoJSON) d'une géométrie.
+    """
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    elif geometry['type'] == 'GeometryCollection':
+        return [poly for g in geometry['geometries'] for poly in polygons(g)]
+    else:
+        return []
+
+
+def polyfill(country, res):
+    """
+    Remplit la surface du pays avec des hexagones (sans passer par le cache).
+
+    Toutes les features du GeoJSON sont prises en compte, y compris les îles
+    et les enclaves des MultiPolygon ; les trous des polygones sont exclus.
+    """
+    with open(geojson_path(country)) as fObj:
+        s = json.load(fObj)
+
+    cells = set()
+    for feature in s['features']:
+        for poly in polygons(feature['geometry']):
+            # geo_json_conformant : les coordonnées restent dans l'ordre (lng, lat) du GeoJSON
+            cells |= h3.polyfill({'type': 'Polygon', 'coordinates': poly}, res, geo_json_conformant=True)
+    return cells
+
+
+def build_grid(cells):
+    """
+    Tableaux décrivant les cellules H3 cells.
+
+    Returns
+    -------
+    ids : ndarray uint64 de taille (n,), triés
+    centroids : ndarray float64 de taille (n, 2), centres (lat, lng)
+    boundaries : ndarray float64 de taille (n, V, 2), contours fermés (lng, lat).
+        Les contours ayant moins de V points sont complétés en répétant leur
+        dernier point, ce qui ne change pas le Polygon.
+    """
+    ids = np.sort(np.array([h3.string_to_h3(c) for c in cells], dtype='uint64'))
+    hexs = [h3.h3_to_string(int(i)) for i in ids]
+
+    centroids = np.array([h3.h3_to_geo(c) for c in hexs], dtype='float64').reshape(-1, 2)
+
+    loops = [h3.h3_to_geo_boundary(c, True) for c in hexs]
+    V = max((len(loop) for loop in loops), default=0)
+    boundaries = np.empty((len(loops), V, 2), dtype='float64')
+    for i, loop in enumerate(loops):
+        boundaries[i, :len(loop)] = loop
+        boundaries[i, len(loop):] = loop[-1]
+
+    return ids, centroids, boundaries
+
+
+def grid_path(country, res):
+    return os.path.join(grid_dir, f"{country}_{res}_{geojson_hash(country)}_v{grid_version}.npz")
+
+
+def load_grid(country, res):
+    """
+    Grille du pays à la résolution res, lue dans le cache si elle y est.
+
+    Returns
+    -------
+    ids, centroids, boundaries : voir build_grid
+    """
+    key = (country, res, geojson_hash(country))
+    if key in _grids:
+        return _grids[key]
+
+    path = grid_path(country, res)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            grid = (data["ids"], data["centroids"], data["boundaries"])
+    else:
+        grid = build_grid(polyfill(country, res))
+        os.makedirs(grid_dir, exist_ok=True)
+        np.savez_compressed(path, ids=grid[0], centroids=grid[1], boundaries=grid[2])
+
+    _grids[key] = grid
+    return grid
+
+
+def _load_grid_in(dirs, country, res):
+    # Dans un processus lancé en "spawn", le module est réimporté : on lui
+    # transmet les dossiers utilisés par le processus parent.
+    global geojson_dir, grid_dir
+    geojson_dir, grid_dir = dirs
+    return load_grid(country, res)
+
+
+def get_grid(countries, res, n_jobs=None):
+    """
+    Grille d'une région formée de plusieurs pays.
+
+    Les grilles absentes du cache (en mémoire et sur le disque) sont calculées
+    en parallèle (un processus par pays) ; les autres sont lues directement. Les cellules communes à deux pays (frontières) ne sont gardées qu'une fois.
+
+    Parameters
+    ----------
+    countries : liste de str
+    res : int
+    n_jobs : int, optionnel
+        Nombre maximal de processus (par défaut, le nombre de cœurs).
+
+    Returns
+    -------
+    ids, centroids, boundaries : voir build_grid. ids est trié, sans doublon.
+    """
+    countries = list(dict.fromkeys(countries))
+    # Lancer des processus coûte cher (chacun réimporte numpy, geopandas, h3) :
+    # on ne le fait que pour les grilles à calculer
+    missing = [c for c in countries
+               if (c, res, geojson_hash(c)) not in _grids and not os.path.exists(grid_path(c, res))]
+
+    if len(missing) > 1:
+        # "spawn" et non "fork" : le processus parent peut déjà faire tourner les
+        # threads de Numba (noyaux prange), qu'un fork laisserait bloqués.
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context) as executor:
+            load = partial(_load_grid_in, (geojson_dir, grid_dir))
+            grids = list(executor.map(load, missing, [res] * len(missing)))
+        for country, g in zip(missing, grids):
+            _grids[(country, res, geojson_hash(country))] = g
+
+    grids = [load_grid(country, res) for country in countries]
+    if len(grids) == 1:
+        return grids[0]
+
+    ids, first = np.unique(np.concatenate([g[0] for g in grids]), return_index=True)
+    centroids = np.concatenate([g[1] for g in grids])[first]
+
+    V = max(g[2].shape[1] for g in grids)
+    boundaries = np.concatenate([
+        np.concatenate([g[2], np.repeat(g[2][:, -1:], V - g[2].shape[1], axis=1)], axis=1)
+        for g in grids])[first]
+
+    return ids, centroids, boundaries
+
+
+###############################
+# Grille adaptative (compacte) #
+###############################
+
+# Dans un grand pays, la plupart des cellules n'ont aucun évènement dans leur
+# 2-ring : leur exposition est nulle à toutes les dates, et leurs séquences
+# d'observations (que des 0) sont toutes identiques. On garde donc la pleine
+# résolution autour des évènements, et on remplace les zones calmes par leurs
+# cellules parentes (h3.compact). Les résultats sont remis à la pleine
+# résolution à l'export (uncompact_df) : ils sont identiques à ceux du calcul
+# sur la grille complète, lignes dans le même ordre (ids H3 croissants).
+
+def compact_grid(ids, centroids, events_h3, k=2):
+    """
+    Grille adaptative : pleine résolution à moins de k anneaux d'un évènement,
+    cellules parentes ailleurs.
+
+    Parameters
+    ----------
+    ids, centroids : grille complète (voir build_grid)
+    events_h3 : ndarray uint64
+        Cellules H3 des évènements, à la résolution de la grille.
+    k : int
+        Rayon (en anneaux) autour des évènements, celui des noyaux d'exposition.
+
+    Returns
+    -------
+    cells : ndarray uint64, de résolutions mélangées. Les cellules sont rangées
+        selon l'id de leur premier enfant à la pleine résolution : en remplaçant
+        chaque parente par ses enfants, on retrouve l'ordre de la grille complète
+        (y compris paquet par paquet, voir exposure_numba.get_observation_fused).
+    cells_coord : ndarray float64 de taille (n, 2), centres (lat, lng)
+    """
+    near = set()
+    for h in np.unique(events_h3):
+        near.update(h3_int.k_ring(int(h), k))
+    active = np.isin(ids, np.fromiter(near, dtype='uint64', count=len(near)))
+
+    # compact ne regroupe que les fratries complètes : les autres cellules calmes restent fines
+    compacted = np.fromiter(h3_int.compact(ids[~active].tolist()), dtype='uint64')
+    cells = np.concatenate([ids[active], compacted])
+    # Le champ résolution est dans les bits de poids fort : trier les ids tels
+    # quels mettrait toutes les parentes avant les cellules fines. Les enfants
+    # d'une parente se suivent dans la grille complète, à partir de son enfant central.
+    res = h3_int.h3_get_resolution(int(ids[0])) if len(ids) else 0
+    first_child = np.array([h3_int.h3_to_center_child(int(c), res) for c in cells], dtype='uint64')
+    cells = cells[np.argsort(first_child)]
+
+    cells_coord = np.empty((len(cells), 2), dtype='float64')
+    fine = np.isin(cells, ids)
+    cells_coord[fine] = centroids[np.searchsorted(ids, cells[fine])]
+    cells_coord[~fine] = np.array([h3_int.h3_to_geo(int(c)) for c in cells[~fine]], dtype='float64').reshape(-1, 2)
+
+    return cells, cells_coord
+
+
+def cell_weights(cells, res):
+    """
+    Nombre de cellules de résolution res que représente chaque cellule (str) de cells.
+    Un pentagone a 6 enfants au lieu de 7.
+    """
+    weights = np.ones(len(cells), dtype='int64')
+    for i, c in enumerate(cells):
+        d = res - h3.h3_get_resolution(c)
+        if d > 0:
+            weights[i] = 1 + 5 * (7**d - 1) // 6 if h3.h3_is_pentagon(c) else 7**d
+    return weights
+
+
+def uncompact_df(df, res, axis=0):
+    """
+    Remet à la résolution res un DataFrame dont les lignes (axis=0) ou les colonnes
+    (axis=1) sont des cellules (str) d'une grille adaptative : chaque cellule parente
+    est remplacée par ses enfants, qui reçoivent ses valeurs. Les cellules sont
+    rangées par id H3 croissant, comme dans la grille complète.
+    """
+    labels = df.index if axis == 0 else df.columns
+
+    children = [sorted(h3.h3_to_children(c, res)) if h3.h3_get_resolution(c) < res else [c] for c in labels]
+    positions = np.repeat(np.arange(len(labels)), [len(ch) for ch in children])
+    new_labels = [c for ch in children for c in ch]
+
+    order = np.argsort(np.array([h3.string_to_h3(c) for c in new_labels], dtype='uint64'), kind='stable')
+    out = df.take(positions[order], axis=axis)
+    new_labels = pd.Index(np.array(new_labels, dtype=object)[order], name=labels.name)
+    if axis == 0:
+        out.index = new_labels
+    else:
+        out.columns = new_labels
+    return out
+
+
+def get_cells(countries, res):
+    """
+    Liste triée des identifiants (str) des cellules H3 des pays countries.
+    """
+    ids, _, _ = get_grid(countries, res)
+    return [h3.h3_to_string(int(i)) for i in ids]
+
+
+def json_to_h3(country, res):
+    """
+    Remplit une surface avec des hexagones.
+
+    Parameters
+    ----------
+    country : str
+    res : int
+        Résolution H3, entre 1 et 16
+
+    Returns
+    -------
+    Liste des identifiants des cellules H3 remplissant la surface.
+    """
+    return get_cells([country], res)
+
+
+def country_grid(country, res):
+    """
+    Crée un GeoDataFrame contenant les Polygons de toutes les cellules remplissant
+    le pays (ou la liste de pays) country.
+    """
+    countries = [country] if isinstance(country, str) else country
+    ids, _, boundaries = get_grid(countries, res)
+
+    df = pd.DataFrame([h3.h3_to_string(int(i)) for i in ids], columns = ['h3'])
+    df['geometry'] = shapely.polygons(boundaries)
+
+    return gpd.GeoDataFrame(df, crs='EPSG:4326')
@@ -148,41 +148,574 @@ def viterbi_log(pi, t, e, obs):
 
 
 
+# Version vectorisée de l'algorithme de Viterbi, sur toutes les cellules à la fois
+def viterbi_batch(pi, t, e, obs, log=False, diagnostics=False, block_size=10000):
+    """
+    Décode d'un coup les séquences d'observations de toutes les cellules.
+
+    Les opérations sont exactement celles de viterbi (ou viterbi_log si log=True),
+    mais diffusées sur un tenseur de scores de taille (cellules, N, N) :
+    les chemins obtenus sont donc identiques.
+
+    Par défaut, on ne garde que le vecteur de scores de l'instant précédent
+    et des pointeurs de retour compressés (voir pack_backtracing), en traitant
+    les cellules par paquets de block_size : la mémoire ne dépend alors plus
+    que de la taille des paquets et de la matrice des chemins.
+
+    Parameters
+    ----------
+    pi, t, e : probabilités initiales, matrices de transition et d'émission
+    obs : ndarray d'entiers de taille (cellules, T)
+        Une séquence d'observations par ligne.
+    log : bool
+        Si True, calcule en log (comme viterbi_log).
+    diagnostics : bool
+        Si True, renvoie aussi le treillis et la matrice de backtracing complets,
+        comme viterbi et viterbi_log.
+    block_size : int
+        Nombre de cellules décodées à la fois.
+
+    Returns
+    -------
+    paths : ndarray int8 de taille (cellules, T)
+        Les séquences d'états cachés les plus probables.
+    treillis, backtracing : ndarray de taille (cellules, N, T)
+        Seulement si diagnostics=True.
+    """
+    obs = np.asarray(obs, dtype='int8')
+    n_cells, T = obs.shape
+
+    pi = np.asarray(pi, dtype='float64')
+    if log:
+        # Mêmes matrices que dans viterbi_log
+        tiny = np.finfo(0.).tiny
+        t = np.log(t + tiny)
+        pi = np.log(pi + tiny)
+        e = np.log(e + tiny)
+        combine = np.add
+    else:
+        combine = np.multiply
+
+    if diagnostics:
+        return viterbi_batch_full(pi, t, e, obs, combine)
+
+    paths = np.zeros((n_cells, T), dtype='int8')
+    for start in range(0, n_cells, block_size):
+        block = slice(start, start + block_size)
+        paths[block] = viterbi_batch_lean(pi, t, e, obs[block], combine)
+
+    return paths
+
+
+def viterbi_batch_full(pi, t, e, obs, combine):
+    """
+    Viterbi vectorisé qui conserve le treillis et la matrice de backtracing.
+    """
+    n_cells, T = obs.shape
+    N = np.shape(e)[0] #nombre d'états
+
+    cells = np.arange(n_cells)
+    paths = np.zeros((n_cells, T), dtype='int8')
+    treillis = np.zeros((n_cells, N, T))
+    backtracing = np.zeros((n_cells, N, T), dtype='int8')
+
+    # Initialisation du treillis
+    treillis[:, :, 0] = combine(pi, e[:, obs[:, 0]].T)
+
+    # Construction du treillis : scores[c, r, s] = treillis[c, r, k-1] (x ou +) t[r, s]
+    for k in range(1, T):
+        scores = combine(treillis[:, :, k-1, None], t[None, :, :])
+        treillis[:, :, k] = combine(np.max(scores, axis=1), e[:, obs[:, k]].T)
+        backtracing[:, :, k] = np.argmax(scores, axis=1)
+
+    # Backtracking
+    paths[:, T-1] = np.argmax(treillis[:, :, T-1], axis=1)
+    for k in range(T-2, -1, -1):
+        paths[:, k] = backtracing[cells, paths[:, k+1], k+1]
+
+    return paths, treillis, backtracing
+
+
+def packing(N):
+    """
+    Nombre de bits par état et type entier permettant de ranger
+    les N pointeurs de retour d'un instant dans un seul entier.
+    Pour nos 5 états : 3 bits chacun, soit 15 bits dans un uint16.
+    """
+    bits = max(1, int(np.ceil(np.log2(N))))
+    for dtype in ['uint8', 'uint16', 'uint32', 'uint64']:
+        if bits * N <= np.dtype(dtype).itemsize * 8:
+            return bits, np.dtype(dtype)
+    raise ValueError(f"Too many states to pack backpointers : {N}")
+
+
+def viterbi_batch_lean(pi, t, e, obs, combine):
+    """
+    Viterbi vectorisé avec deux vecteurs de scores glissants et des pointeurs
+    de retour compressés : un entier de taille (T, cellules) au lieu de deux
+    matrices float64 de taille (cellules, N, T).
+    """
+    n_cells, T = obs.shape
+    N = np.shape(e)[0] #nombre d'états
+
+    bits, dtype = packing(N)
+    shifts = (bits * np.arange(N)).astype(dtype)
+    mask = (1 << bits) - 1
+
+    paths = np.zeros((n_cells, T), dtype='int8')
+    backtracing = np.zeros((T, n_cells), dtype=dtype)
+
+    score = combine(pi, e[:, obs[:, 0]].T)
+
+    for k in range(1, T):
+        scores = combine(score[:, :, None], t[None, :, :])
+        arg = np.argmax(scores, axis=1)
+        # Le maximum se lit directement à l'argmax, sans second passage
+        best = np.take_along_axis(scores, arg[:, None, :], axis=1)[:, 0, :]
+        score = combine(best, e[:, obs[:, k]].T)
+        backtracing[k] = np.bitwise_or.reduce(arg.astype(dtype) << shifts, axis=1)
+
+    # Backtracking
+    paths[:, T-1] = np.argmax(score, axis=1)
+    for k in range(T-2, -1, -1):
+        paths[:, k] = (backtracing[k+1] >> shifts[paths[:, k+1]]) & mask
+
+    return paths
+
+
+
+###############################
+# Algorithme forward-backward #
+###############################
+
+
+def forward_backward_block(pi, t, e, obs):
+    """
+    Algorithme forward-backward normalisé, vectorisé sur un paquet de cellules.
+
+    A chaque instant, alpha est renormalisé par scale[k] = P(o_k | o_0..o_k-1),
+    et beta par le même facteur : alpha * beta donne alors directement les
+    probabilités a posteriori, sans passer par le log.
+
+    Parameters
+    ----------
+    pi, t, e : probabilités initiales, matrices de transition et d'émission
+    obs : ndarray d'entiers de taille (cellules, T)
+
+    Returns
+    -------
+    alpha, beta : ndarray de taille (T, cellules, N)
+    scale : ndarray de taille (T, cellules)
+    """
+    n_cells, T = obs.shape
+    N = np.shape(e)[0] #nombre d'états
+
+    pi = np.asarray(pi, dtype='float64')
+    t = np.asarray(t, dtype='float64')
+    e = np.asarray(e, dtype='float64')
+
+    alpha = np.zeros((T, n_cells, N))
+    beta = np.zeros((T, n_cells, N))
+    scale = np.zeros((T, n_cells))
+
+    # Forward
+    a = pi * e[:, obs[:, 0]].T
+    scale[0] = a.sum(axis=1)
+    alpha[0] = a / scale[0, :, None]
+    for k in range(1, T):
+        a = (alpha[k-1] @ t) * e[:, obs[:, k]].T
+        scale[k] = a.sum(axis=1)
+        alpha[k] = a / scale[k, :, None]
+
+    # Backward
+    beta[T-1] = 1
+    for k in range(T-2, -1, -1):
+        b = (e[:, obs[:, k+1]].T * beta[k+1]) @ t.T
+        beta[k] = b / scale[k+1, :, None]
+
+    return alpha, beta, scale
+
+
+def fb_block_size(T, N, n_arrays, memory):
+    """
+    Nombre de cellules par paquet pour que n_arrays tableaux float64 de taille
+    (T, cellules, N) tiennent dans memory octets.
+    """
+    return max(1, int(memory // (n_arrays * T * N * 8)))
+
+
+def forward_backward_batch(pi, t, e, obs, block_size=None, path=None, memory=256 * 2**20):
+    """
+    Calcule les probabilités a posteriori des états cachés de toutes les cellules.
+
+    Parameters
+    ----------
+    pi, t, e : probabilités initiales, matrices de transition et d'émission
+    obs : ndarray d'entiers de taille (cellules, T)
+    block_size : int, optionnel
+        Nombre de cellules traitées à la fois. Par défaut, il est déduit de T
+        et de memory (alpha et beta d'un paquet tiennent dans memory octets).
+    memory : int
+        Mémoire (en octets) accordée aux tableaux d'un paquet.
+    path : str, optionnel
+        Si renseigné, le cube est écrit paquet par paquet dans ce fichier .npy
+        (memmap) au lieu d'être gardé en mémoire.
+
+    Returns
+    -------
+    posteriors : ndarray float32 de taille (cellules, T, N)
+        posteriors[c, k, s] = P(état s à l'instant k | observations de c)
+    log_likelihood : ndarray de taille (cellules,)
+        Log-vraisemblance des observations de chaque cellule.
+    """
+    obs = np.asarray(obs, dtype='int8')
+    n_cells, T = obs.shape
+    N = np.shape(e)[0] #nombre d'états
+
+    if path is None:
+        posteriors = np.zeros((n_cells, T, N), dtype='float32')
+    else:
+        posteriors = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=(n_cells, T, N))
+    log_likelihood = np.zeros(n_cells)
+
+    if block_size is None:
+        block_size = fb_block_size(T, N, 2, memory)
+
+    for start in range(0, n_cells, block_size):
+        block = slice(start, start + block_size)
+        alpha, beta, scale = forward_backward_block(pi, t, e, obs[block])
+
+        # Produit fait sur place dans alpha, puis converti en float32 à l'écriture
+        # (l'affectation de la vue transposée ne crée pas de copie intermédiaire)
+        np.multiply(alpha, beta, out=alpha)
+        del beta
+        posteriors[block] = alpha.transpose(1, 0, 2)
+        log_likelihood[block] = np.log(scale).sum(axis=0)
+
+    if path is not None:
+        posteriors.flush()
+
+    return posteriors, log_likelihood
+
+
+
+###################################
+# Viterbi en ligne, à retard fixe #
+###################################
+
+
+class OnlineViterbi:
+    """
+    Décodage de Viterbi en ligne, pour les mises à jour mensuelles.
+
+    Pour chaque cellule, on ne garde que le dernier vecteur de scores (en log)
+    et les pointeurs de retour des lag derniers instants (compressés comme dans
+    viterbi_batch_lean). Chaque nouvelle colonne d'observations coûte donc O(1)
+    par cellule, au lieu de refaire tout le chemin depuis la date de départ.
+
+    A l'instant k, update renvoie l'état estimé à l'instant k - lag : plus le retard
+    est grand, plus la décision tient compte des observations qui suivent.
+    Avec lag >= T, flush redonne exactement le chemin de viterbi_log.
+    """
+
+    def __init__(self, pi, n_cells, lag, t=t, e=e):
+        # Mêmes matrices que dans viterbi_log
+        tiny = np.finfo(0.).tiny
+        self.pi_log = np.log(np.asarray(pi, dtype='float64') + tiny)
+        self.t_log = np.log(np.asarray(t, dtype='float64') + tiny)
+        self.e_log = np.log(np.asarray(e, dtype='float64') + tiny)
+
+        self.n_cells = n_cells
+        self.lag = lag
+        self.k = 0 # nombre d'observations reçues
+
+        N = np.shape(e)[0] #nombre d'états
+        self.bits, dtype = packing(N)
+        self.shifts = (self.bits * np.arange(N)).astype(dtype)
+        self.score = np.zeros((n_cells, N))
+        # Fenêtre circulaire : les pointeurs de l'instant k sont rangés en k % lag
+        self.backtracing = np.zeros((lag, n_cells), dtype=dtype)
+
+    def update(self, obs):
+        """
+        Ajoute une colonne d'observations (une par cellule).
+
+        Returns
+        -------
+        ndarray int8 de taille (cellules,) : les états à l'instant k - lag,
+        ou None tant que moins de lag + 1 observations ont été reçues.
+        """
+        obs = np.asarray(obs, dtype='int8')
+
+        if self.k == 0:
+            self.score = self.pi_log + self.e_log[:, obs].T
+        else:
+            scores = self.score[:, :, None] + self.t_log[None, :, :]
+            arg = np.argmax(scores, axis=1)
+            best = np.take_along_axis(scores, arg[:, None, :], axis=1)[:, 0, :]
+            self.score = best + self.e_log[:, obs].T
+            if self.lag > 0:
+                self.backtracing[self.k % self.lag] = np.bitwise_or.reduce(arg.astype(self.shifts.dtype) << self.shifts, axis=1)
+
+        # Les scores ne sont pas recentrés : soustraire le maximum changerait les
+        # arrondis, donc le choix entre chemins ex aequo (fréquents, t et e répétant
+        # les mêmes valeurs), et flush ne redonnerait plus viterbi_log. Ils ne
+        # baissent que de quelques unités par instant : float64 suffit largement.
+        self.k += 1
+
+        if self.k <= self.lag:
+            return None
+        return self.backtrack(self.lag)[:, 0]
+
+    def backtrack(self, length):
+        """
+        Remonte le chemin le plus probable sur les length derniers instants.
+
+        Returns
+        -------
+        ndarray int8 de taille (cellules, length + 1) : les états aux instants k-1-length, ..., k-1.
+        """
+        mask = (1 << self.bits) - 1
+        path = np.zeros((self.n_cells, length + 1), dtype='int8')
+
+        path[:, length] = np.argmax(self.score, axis=1)
+        for j in range(length, 0, -1):
+            step = self.k - 1 - (length - j)
+            path[:, j-1] = (self.backtracing[step % self.lag] >> self.shifts[path[:, j]]) & mask
+
+        return path
+
+    def flush(self):
+        """
+        Renvoie les états des instants pas encore émis par update,
+        sous la forme d'une matrice int8 de taille (cellules, min(lag, k)).
+        """
+        length = min(self.lag, self.k)
+        if length == 0:
+            return np.zeros((self.n_cells, 0), dtype='int8')
+        return self.backtrack(length - 1)
+
+    def save(self, path):
+        """
+        Enregistre l'état du décodeur dans un fichier .npz.
+        """
+        np.savez(path, pi_log=self.pi_log, t_log=self.t_log, e_log=self.e_log,
+                 k=self.k, lag=self.lag, score=self.score, backtracing=self.backtracing)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Recharge un décodeur enregistré avec save.
+        """
+        data = np.load(path)
+
+        decoder = cls(np.exp(data['pi_log']), data['score'].shape[0], int(data['lag']),
+                      np.exp(data['t_log']), np.exp(data['e_log']))
+        decoder.pi_log, decoder.t_log, decoder.e_log = data['pi_log'], data['t_log'], data['e_log']
+        decoder.k = int(data['k'])
+        decoder.score = data['score']
+        decoder.backtracing = data['backtracing']
+
+        return decoder
+
+
+
+##########################################
+# Estimation des paramètres (Baum-Welch) #
+##########################################
+
+
+def expected_counts(pi, t, e, obs):
+    """
+    Etape E de l'algorithme de Baum-Welch sur un paquet de cellules.
+
+    Renvoie les nombres espérés (sommés sur les cellules) d'états initiaux,
+    de transitions et d'émissions, ainsi que la log-vraisemblance du paquet.
+    """
+    M = np.shape(e)[1] #nombre d'observations possibles
+
+    alpha, beta, scale = forward_backward_block(pi, t, e, obs)
+
+    # xi[k, c, r, s] = alpha[k-1, c, r] * t[r, s] * e[s, o_k] * beta[k, c, s] / scale[k, c],
+    # sommé directement sur les instants et les cellules
+    after = e.T[obs[:, 1:].T] # (T-1, cellules, N)
+    after *= beta[1:]
+    after /= scale[1:, :, None]
+    t_counts = t * np.einsum('kcr,kcs->rs', alpha[:-1], after)
+    del after
+
+    # gamma = alpha * beta, calculé sur place
+    gamma = np.multiply(alpha, beta, out=alpha)
+    del beta
+
+    pi_counts = gamma[0].sum(axis=0)
+
+    e_counts = np.zeros((np.shape(e)[0], M))
+    for o in range(M):
+        e_counts[:, o] = np.einsum('kcs,kc->s', gamma, obs.T == o)
+
+    return pi_counts, t_counts, e_counts, np.log(scale).sum()
+
+
+def normalize_rows(counts, previous):
+    """
+    Normalise les lignes d'une matrice de comptes.
+    Les lignes sans aucun compte (état jamais visité) gardent leur valeur précédente.
+    """
+    sums = counts.sum(axis=-1, keepdims=True)
+    return np.where(sums > 0, counts / np.where(sums > 0, sums, 1), previous)
+
+
+def baum_welch(obs, pi, t=t, e=e, tol=1e-6, max_iter=100, block_size=None, verbose=True, memory=256 * 2**20):
+    """
+    Estime pi, t et e à partir des observations de toutes les cellules d'un pays.
+
+    Les cellules partagent les mêmes paramètres : à chaque itération, l'étape E
+    accumule les nombres espérés sur des paquets de block_size cellules, traités
+    de façon vectorisée, puis l'étape M renormalise. Par défaut, block_size est
+    déduit de T et de memory (voir forward_backward_batch).
+
+    Parameters
+    ----------
+    obs : ndarray d'entiers de taille (cellules, T)
+    pi, t, e : paramètres de départ (par défaut, les matrices t et e du module)
+    tol : float
+        On s'arrête quand la log-vraisemblance progresse de moins de tol (en relatif).
+    max_iter : int
+        Nombre maximal d'itérations.
+    verbose : bool
+        Affiche la log-vraisemblance à chaque itération.
+
+    Returns
+    -------
+    pi, t, e : paramètres estimés
+    log_likelihoods : list
+        Log-vraisemblance totale à chaque itération (avant la mise à jour).
+    """
+    obs = np.asarray(obs, dtype='int8')
+    n_cells, T = obs.shape
+
+    if block_size is None:
+        # alpha, beta et le tableau des transitions d'expected_counts
+        block_size = fb_block_size(T, np.shape(e)[0], 3, memory)
+
+    pi = np.asarray(pi, dtype='float64').copy()
+    t = np.asarray(t, dtype='float64').copy()
+    e = np.asarray(e, dtype='float64').copy()
+
+    log_likelihoods = []
+
+    for i in range(max_iter):
+        # Etape E
+        pi_counts = np.zeros_like(pi)
+        t_counts = np.zeros_like(t)
+        e_counts = np.zeros_like(e)
+        log_likelihood = 0
+
+        for start in range(0, n_cells, block_size):
+            counts = expected_counts(pi, t, e, obs[start:start + block_size])
+            pi_counts += counts[0]
+            t_counts += counts[1]
+            e_counts += counts[2]
+            log_likelihood += counts[3]
+
+        log_likelihoods.append(log_likelihood)
+        if verbose:
+            print(f"Iteration {i} : log-likelihood = {log_likelihood}")
+
+        # Etape M
+        pi = normalize_rows(pi_counts, pi)
+        t = normalize_rows(t_counts, t)
+        e = normalize_rows(e_counts, e)
+
+        if i > 0 and log_likelihood - log_likelihoods[-2] <= tol * abs(log_likelihoods[-2]):
+            break
+
+    return pi, t, e, log_likelihoods
+
+
+
 ################################
 # Application avec nos données #
 ################################
 
 
-def get_states(observations_df, pi):
-    observations_df = observations_df.T
-
-    states_df = pd.DataFrame(index=observations_df.index)
+def states_to_df(paths, observations_df):
+    """
+    Met en forme une matrice d'états (cellules, dates) comme le faisaient
+    get_states et get_states_viterbilog : dates en ligne, cellules en colonne.
 
-    for cell in observations_df.columns:
-        obs = observations_df[cell].to_numpy(dtype='int8')
-        
-        path, _, _ = viterbi(pi, t, e, obs)
-        
-        state_path = [state_map[v] for v in path]
-        states_df[cell] = state_path
+    Chaque colonne est un Categorical dont les codes sont directement les
+    états int8 de paths : on ne crée pas de matrice de chaînes de caractères.
+    Les noms des états ('R', 'DR', ...) n'apparaissent qu'à l'écriture du .csv.
+    """
+    dtype = pd.CategoricalDtype(hidden_states)
+    columns = {c: pd.Categorical.from_codes(paths[c], dtype=dtype) for c in range(paths.shape[0])}
 
+    states_df = pd.DataFrame(columns, index=observations_df.columns)
+    states_df.columns = observations_df.index
     return states_df
 
 
-def get_states_viterbilog(observations_df, pi):
-    observations_df = observations_df.T
+def get_states(observations_df, pi, engine="numpy", dedupe=True):
+    """
+    Détermine la séquence de contrôle de chaque cellule.
 
-    states_df = pd.DataFrame(index=observations_df.index)
+    engine : "numpy" (viterbi_batch), "numpy_log" (viterbi_batch en log) ou
+    "numba" (viterbi en log, compilé et parallélisé sur les cellules, voir hmm_numba.py).
+    "numpy_log" et "numba" donnent les mêmes états ; "numpy" peut en différer
+    sur les longues séquences, où les produits de probabilités sous-passent.
+    dedupe : décode une seule fois chaque séquence d'observations distincte
+    (beaucoup de cellules, sans aucune exposition, n'observent que des 0).
+    """
+    obs = observations_df.to_numpy(dtype='int8')
 
-    for cell in observations_df.columns:
-        obs = observations_df[cell].to_numpy(dtype='int8')
-        
-        path, _, _ = viterbi_log(pi, t, e, obs)
-        
-        state_path = [state_map[v] for v in path]
-        states_df[cell] = state_path
+    if dedupe and len(obs) > 0:
+        obs, inverse = np.unique(obs, axis=0, return_inverse=True)
 
-    return states_df
+    if engine == "numba":
+        import hmm_numba
+        paths = hmm_numba.viterbi_log_numba(pi, t, e, obs)
+    elif engine == "numpy_log":
+        paths = viterbi_batch(pi, t, e, obs, log=True)
+    elif engine == "numpy":
+        paths = viterbi_batch(pi, t, e, obs)
+    else:
+        raise ValueError(f"Unknown engine : {engine}")
+
+    if dedupe and len(paths) > 0:
+        paths = paths[inverse.ravel()]
+
+    return states_to_df(paths, observations_df)
+
+
+def get_posteriors(observations_df, pi, path=None):
+    """
+    Probabilités a posteriori de chaque état (R, DR, D, DG, G) pour chaque cellule et chaque date.
+
+    Renvoie un cube float32 de taille (cellules, dates, 5), dans l'ordre
+    des lignes et des colonnes de observations_df. Si path est renseigné,
+    le cube est écrit dans ce fichier .npy.
+    """
+    obs = observations_df.to_numpy(dtype='int8')
+
+    posteriors, _ = forward_backward_batch(pi, t, e, obs, path=path)
+
+    return posteriors
+
+
+def fit_parameters(observations_df, pi, **kwargs):
+    """
+    Estime pi, t et e (Baum-Welch) à partir d'une matrice d'observations,
+    en partant des valeurs actuelles. Les options sont celles de baum_welch.
+    """
+    obs = observations_df.to_numpy(dtype='int8')
+
+    return baum_welch(obs, pi, t, e, **kwargs)
+
+
+def get_states_viterbilog(observations_df, pi):
+    return get_states(observations_df, pi, engine="numpy_log")
 
 
 def test_viterbit():
@@ -0,0 +1,75 @@
+import numpy as np
+from numba import njit, prange
+
+
+##############################################
+# Algorithme de Viterbi (log), version Numba #
+##############################################
+
+# Même calcul que hmm.viterbi_log, mais compilé et parallélisé sur les cellules.
+# cache=True : le code compilé est enregistré dans __pycache__, on ne paie
+# donc la compilation qu'au premier lancement.
+
+@njit(parallel=True, cache=True)
+def viterbi_log_cells(pi_log, t_log, e_log, obs):
+    """
+    Décode les séquences d'observations de toutes les cellules, en log.
+
+    Parameters
+    ----------
+    pi_log, t_log, e_log : ndarray
+        Logarithmes des probabilités initiales et des matrices de transition et d'émission.
+    obs : ndarray int8 de taille (cellules, T)
+
+    Returns
+    -------
+    paths : ndarray int8 de taille (cellules, T)
+    """
+    n_cells, T = obs.shape
+    N = e_log.shape[0]
+
+    paths = np.zeros((n_cells, T), dtype=np.int8)
+
+    for c in prange(n_cells):
+        # Pointeurs de retour sur un octet au lieu d'une matrice float64
+        backtracing = np.zeros((T, N), dtype=np.uint8)
+        prev = np.empty(N, dtype=np.float64)
+        cur = np.empty(N, dtype=np.float64)
+
+        for s in range(N):
+            prev[s] = pi_log[s] + e_log[s, obs[c, 0]]
+
+        for k in range(1, T):
+            for s in range(N):
+                # np.argmax garde le premier maximum : on fait de même avec >
+                best = prev[0] + t_log[0, s]
+                arg = 0
+                for r in range(1, N):
+                    v = prev[r] + t_log[r, s]
+                    if v > best:
+                        best = v
+                        arg = r
+                cur[s] = best + e_log[s, obs[c, k]]
+                backtracing[k, s] = arg
+            prev, cur = cur, prev
+
+        # Backtracking
+        paths[c, T-1] = np.argmax(prev)
+        for k in range(T-2, -1, -1):
+            paths[c, k] = backtracing[k+1, paths[c, k+1]]
+
+    return paths
+
+
+def viterbi_log_numba(pi, t, e, obs):
+    """
+    Equivalent de hmm.viterbi_batch(pi, t, e, obs, log=True) avec le moteur Numba.
+    """
+    tiny = np.finfo(0.).tiny
+    t_log = np.log(np.asarray(t, dtype='float64') + tiny)
+    pi_log = np.log(np.asarray(pi, dtype='float64') + tiny)
+    e_log = np.log(np.asarray(e, dtype='float64') + tiny)
+
+    obs = np.ascontiguousarray(obs, dtype='int8')
+
+    return viterbi_log_cells(pi_log, t_log, e_log, obs)
@@ -1,27 +1,73 @@
 import numpy as np
-from scipy.special import factorial as fact
+from scipy.special import factorial as fact, gammaln, xlogy
 import pandas as pd
 
 def poisson(n, mean):
     return np.exp(-mean)*(mean**n)/fact(n)
 
 
-def get_probabilities(E):
+def log_poisson(n, mean):
+    # Même loi que poisson, mais en log : mean**n / n! ne déborde plus
+    # pour les grandes expositions. xlogy(0, 0) = 0, comme 0**0 = 1.
+    return xlogy(n, mean) - mean - gammaln(n + 1)
+
+
+def probabilities(E, means=None, dtype='float64', weights=None):
+    """
+    Calcule d'un coup les probabilités d'exposition d'un tableau numpy (cellules, dates).
+
+    means : exposition moyenne de chaque date (par défaut, la moyenne de chaque colonne de E)
+    dtype : 'float64' ou 'float32'
+    weights : nombre de cellules que représente chaque ligne (grille adaptative,
+    voir grid.cell_weights), pour le calcul de la moyenne
+    """
+    E = np.asarray(E, dtype=dtype)
+
+    if means is None and weights is None:
+        means = np.nanmean(E, axis=0)
+    elif means is None:
+        w = np.where(np.isnan(E), 0, np.asarray(weights, dtype=dtype)[:, None])
+        means = np.nansum(E * w, axis=0) / w.sum(axis=0)
+    means = np.asarray(means, dtype=dtype)
+
+    return np.exp(log_poisson(E, means[None, :]))
+
+
+def get_probabilities(E, dtype='float64', weights=None):
     """
     Calcule les probabilités d'exposition en fonction d'une matrice de mesure d'exposition
     E : exposure matrix
+    weights : voir probabilities
+    """
+    # Pour chaque date, la loi de Poisson a pour paramètre l'exposition moyenne.
+    # Remarque : on n'est pas obligé de prendre la partie entière de x,
+    # car gammaln prolonge la factorielle à partir de la fonction gamma.
+    F = probabilities(E.to_numpy(), dtype=dtype, weights=weights)
+
+    return pd.DataFrame(F, index=E.index, columns=E.columns)
+
+
+def observations(Et, Ec, C, T, m, xs):
+    """
+    Calcule d'un coup les codes d'observation à partir de tableaux numpy alignés (cellules, dates).
+
+    Mêmes règles que get_observation, appliquées sur tout le tableau avec des masques :
+    * 0 si les deux expositions (tronquées à xs) sont nulles,
+    * 2 si les probabilités T et C sont à moins de m l'une de l'autre,
+    * 1 si C > T,
+    * 3 sinon.
+
+    Returns
+    -------
+    ndarray int8 de taille (cellules, dates)
     """
-    F = E.copy()
+    Et, Ec = np.asarray(Et), np.asarray(Ec)
+    C, T = np.asarray(C), np.asarray(T)
 
-    for c in E.columns:
-        # Calcule l'exposition moyenne par mois
-        l = E[c].mean()
-        
-        # Remarque : on n'est pas obligé de prendre la partie entière de x,
-        # car le fact de SciPy calcule la factorielle à partir de la fonction gamma.
-        F[c] = E[c].apply(lambda x: poisson(x, l))
+    # Troncature des expositions : les valeurs inférieures à xs valent 0
+    no_exposure = (np.where(Et < xs, 0, Et) == 0) & (np.where(Ec < xs, 0, Ec) == 0)
 
-    return F
+    return np.select([no_exposure, np.abs(T - C) <= m, C > T], [0, 2, 1], 3).astype('int8')
 
 
 def get_observation(Et, Ec, C, T, m, xs):
@@ -32,42 +78,11 @@ def get_observation(Et, Ec, C, T, m, xs):
     m : chevauchement des probabilités d'exposition
     xs : les expositions observées inférieures à xs sont tronquées à 0
     """
+    O = observations(Et.to_numpy(), Ec.loc[Et.index, Et.columns].to_numpy(),
+                     C.loc[Et.index, Et.columns].to_numpy(), T.loc[Et.index, Et.columns].to_numpy(),
+                     m, xs)
 
-    def preprocess_exposures(x):
-        if x < xs:
-            return 0
-        else:
-            return x
-
-    def cell_observation(row):
-        if row['Et'] == 0 and row['Ec'] == 0:
-            return 0
-        elif abs(row['T'] - row['C']) <= m:
-            return 2
-        elif row['C'] > row['T']:
-            return 1
-        else:
-            return 3
-    
-    # Initialiser un DF d'observations vide
-    O = pd.DataFrame(index=Et.index)
-
-    for date in Et.columns:
-        # Construire un nouveau dataframe pour la date
-        df = pd.concat([Et[date],Ec[date],C[date],T[date]], axis=1).copy()
-        df.columns = ['Et', 'Ec','C', 'T']
-
-        # Troncature des expositions
-        df['Et'] = df['Et'].apply(preprocess_exposures)
-        df['Ec'] = df['Ec'].apply(preprocess_exposures)
-
-        # Déterminer l'observation
-        df["observation"] = df.apply(cell_observation, axis=1)
-
-        # Ajouter la colonne d'observation pour la date donnée
-        O[date] = df["observation"]
-
-    return O
+    return pd.DataFrame(O, index=Et.index, columns=Et.columns)
 
 
 def main():
@@ -1,5 +1,5 @@
 class Parameters:
-    def __init__(self, ged_path, gtd_path, startdate, enddate, countries, perpetrators, h3_level, freq):
+    def __init__(self, ged_path, gtd_path, startdate, enddate, countries, perpetrators, h3_level, freq, n_threads=None):
         self.ged_path = ged_path
         self.gtd_path = gtd_path
         self.startdate = startdate
@@ -8,6 +8,7 @@ class Parameters:
         self.perpetrators = perpetrators
         self.h3_level = h3_level
         self.freq = freq
+        self.n_threads = n_threads # Nombre de threads Numba (None : tous les coeurs)
 
     def get_params(self):
         return (self.startdate, 
@@ -43,7 +44,10 @@ def ask_params():
 
     freq = input("Enter frequency (default is M) > ") or "M"
 
-    params = Parameters(ged_path, gtd_path, startdate, enddate, countries, perpetrators, h3_level, freq)
+    n_threads = input("Enter number of threads (default is all cores) > ")
+    n_threads = int(n_threads) if n_threads else None
+
+    params = Parameters(ged_path, gtd_path, startdate, enddate, countries, perpetrators, h3_level, freq, n_threads)
 
     return params
 
@@ -1,41 +1,61 @@
+import os
+import re
+import hashlib
 import pandas as pd
 import numpy as np
 import h3
+import warnings
 import parameters as prm
 
+with warnings.catch_warnings():
+    # h3.unstable prévient que son interface peut changer
+    warnings.simplefilter("ignore")
+    try:
+        from h3.unstable import vect as h3_vect
+    except ImportError:
+        h3_vect = None
+
 
 ###########################
 # GED data precleaning
 ###########################
 
-def get_ged_df(path):
+def get_ged_df(path, startdate=None, enddate=None, countries=None, chunksize=100000):
     """
     Charge la base de donnée GED et sélectionne les variables utiles.
+
+    Seules les colonnes utiles sont lues, avec des types compacts, par paquets
+    de chunksize lignes. Si countries, startdate ou enddate sont renseignés,
+    chaque paquet est filtré dès sa lecture : les évènements des autres pays
+    ne sont jamais tous en mémoire en même temps.
     """
-    ged_dtype = {'year': int,
-                 'type_of_violence' : int,
-                 'side_a' : str,
-                 'side_b' : str,
-                 'source_article' : str,
-                 'source_headline' : str,
-                 'where_prec' : int,
+    ged_dtype = {'id' : 'int64',
+                 'type_of_violence' : 'int8',
+                 'side_b' : 'category',
+                 'where_prec' : 'int8',
                  'latitude' : float,
                  'longitude' : float,
-                 'geom_wkt' : str, # A préciser peut-être ?
-                 'priogrid_gid' : int,
-                 'country' : str,
-                 'date_prec' : int,
+                 'country' : 'category',
+                 'date_prec' : 'int8',
                  'date_start' : str,
                  'date_end' : str,
-                 'deaths_a' : int,
-                 'death_b' : int,
-                 'deaths_civilians' : int,
-                 'deaths_unknown' : int,
-                 'best' : int,
-                 'high' : int,
-                 'low' : int}
+                 'best' : 'int32'}
+
+    chunks = []
+    for ged in pd.read_csv(path, usecols=list(ged_dtype), dtype=ged_dtype, chunksize=chunksize):
+        if countries is not None:
+            ged = ged[ged['country'].isin(countries)]
+        ged = clean_ged(ged)
+        chunks.append(select_dates(ged, startdate, enddate))
+
+    return to_categories(concat_chunks(chunks), ['country', 'perpetrator', 'type'])
 
-    ged = pd.read_csv(path, dtype = ged_dtype) 
+
+def clean_ged(ged):
+    """
+    Nettoie un paquet de lignes de la base GED.
+    """
+    ged = ged.copy()
 
     ged['date_start'] = pd.to_datetime(ged['date_start'])
     ged['date_end'] = pd.to_datetime(ged['date_end'])
@@ -45,6 +65,8 @@ def get_ged_df(path):
     ged['month'] = ged['date_start'].dt.month
     ged['year'] = ged['date_start'].dt.year
     ged['duration'] = ged['date_end'] - ged['date_start'] + pd.Timedelta("1 days")
+    # Identifiant stable d'un évènement, commun aux deux bases (voir exposure_numba.get_exposure)
+    ged['event_id'] = "ged-" + ged['id'].astype(str)
 
     # Selecting relevant observations
     # a) state-based conflict. In state-based armed conflicts, at least one of the primary parties must be the government of a state.
@@ -55,6 +77,7 @@ def get_ged_df(path):
     # Select relevant variables
 
     ged = ged[[
+        'event_id',
         'year',
         'month', 
         'day', 
@@ -87,45 +110,68 @@ def get_ged_df(path):
 # GTD data precleaning
 ###########################
 
-def get_gtd_df(path):
+def get_gtd_df(path, startdate=None, enddate=None, countries=None, chunksize=100000):
     """
     Charge la base de donnée GTd et sélectionne les variables utiles.
+
+    Comme pour get_ged_df : seules les colonnes utiles sont lues, avec des types
+    compacts, par paquets filtrés dès leur lecture.
     """    
-    gtd_dtype = {'iyear' : int,
-                 'imonth' : int,
-                 'iday' : int,
-                 'extended' : int,
-                 'country_txt' : str,
+    # Les colonnes qui peuvent être vides sont lues en float
+    gtd_dtype = {'eventid' : 'int64',
+                 'iyear' : 'int16',
+                 'imonth' : 'int8',
+                 'iday' : 'int8',
+                 'approxdate' : str,
+                 'extended' : 'int8',
+                 'resolution' : str,
+                 'country_txt' : 'category',
                  'latitude' : float,
                  'longitude' : float,
-                 'specificity' : int,
-                 'summary' : str,
-                 'doutterr' : int,
-                 'alternative' : int,
-                 'multiple' : int,
-                 'success' : int,
-                 'attacktype1' : int,
-                 'attacktype_txt' : str,
-                 'targtype1' : int,
-                 'targtype1_txt' : str,
-                 'targsubtype1' : int,
-                 'targsubtype1_txt' : str,
-                 'gname' : str,
-                 'weaptype1' : int,
-                 'weaptype1_txt' : str,
-                 'weapsubtype1' : int,
-                 'weapsubtupe1_txt' : str,
-                 'nkill' : int,
-                 'nwound' : int}
-
-    gtd = pd.read_csv(path)
+                 'specificity' : 'float32',
+                 'doubtterr' : 'float32',
+                 'attacktype1' : 'int8',
+                 'attacktype1_txt' : 'category',
+                 'targtype1' : 'int8',
+                 'gname' : 'category',
+                 'nkill' : float}
 
+    chunks = []
+    for gtd in pd.read_csv(path, usecols=list(gtd_dtype), dtype=gtd_dtype, chunksize=chunksize):
+        if countries is not None:
+            gtd = gtd[gtd['country_txt'].isin(countries)]
+        chunks.append(clean_gtd(gtd, startdate, enddate))
+
+    return to_categories(concat_chunks(chunks), ['country', 'perpetrator', 'type', 'attacktype1_txt'])
+
+
+def clean_gtd(gtd, startdate=None, enddate=None):
+    """
+    Nettoie un paquet de lignes de la base GTD.
+
+    Les filtres (dates, puis critères de sélection) sont appliqués avant
+    tout calcul de colonne dérivée : celles-ci ne sont calculées que pour
+    les évènements conservés.
+    """
     # Rename columns
-    gtd.rename(columns = {
+    gtd = gtd.rename(columns = {
         'iyear' : 'year',
         'imonth' : 'month',
         'iday' : 'day'
-    }, inplace = True)
+    })
+
+    # Premier tri, peu coûteux, sur l'année
+    if startdate is not None:
+        gtd = gtd[gtd['year'] >= pd.Timestamp(startdate).year]
+    if enddate is not None:
+        gtd = gtd[gtd['year'] <= pd.Timestamp(enddate).year]
+
+    # Filtering out events 
+    # a) not clearly terrorism
+    # b) not attributable to min 2nd order admin region
+    # c) Main model: removing attacks against military
+
+    gtd = gtd[(gtd['targtype1'] != 4) & (gtd['doubtterr'] == 0) & gtd['specificity'].isin([1, 2, 3])].copy()
 
     # Set 0 day/month value to 1 for conversion to Timestamp
     gtd.loc[gtd['day'] == 0, 'day'] = 1
@@ -133,38 +179,26 @@ def get_gtd_df(path):
 
     #gtd['doubtterr'] = gtd['doubtterr'].replace(-9, np.NaN)
     gtd['date_start'] = pd.to_datetime(gtd[['year', 'month', 'day']])
+    gtd = select_dates(gtd, startdate, enddate)
+
     gtd['date_end'] = pd.to_datetime(gtd['resolution'])
     gtd['duration'] = gtd['date_end'] - gtd['date_start'] + pd.Timedelta("1 days")
     gtd['type'] = "terrorism"
+    gtd['event_id'] = "gtd-" + gtd['eventid'].astype(str)
     gtd.loc[gtd['extended'] == 0, 'duration'] = pd.Timedelta("1 days")
 
     # Coding a time precision variable
-    def calc_date_prec(row):
-        # Y a peut-être plus simple comme écriture, mais bon.
-        date_prec = np.NaN
-        if row['approxdate'] == "":
-            date_prec = 1
-        else:
-            date_prec = 2
-        if row['month'] != 0 and row['day'] == 0:
-            date_prec = 3
-        if row['month'] == 0:
-            date_prec = 5
-
-        return date_prec
-
-    gtd['date_prec'] = gtd.apply(calc_date_prec, axis = 1)
-
-    # Filtering out events 
-    # a) not clearly terrorism
-    # b) not attributable to min 2nd order admin region
-    # c) Main model: removing attacks against military
-
-    gtd = gtd[(gtd['targtype1'] != 4) & (gtd['doubtterr'] == 0) & gtd['specificity'].isin([1, 2, 3])]
+    # (les mois et jours nuls ont été mis à 1 plus haut : les cas 3 et 5
+    # ne se présentent donc pas, comme dans la version ligne par ligne)
+    date_prec = np.where(gtd['approxdate'] == "", 1, 2)
+    date_prec[(gtd['month'] != 0).to_numpy() & (gtd['day'] == 0).to_numpy()] = 3
+    date_prec[(gtd['month'] == 0).to_numpy()] = 5
+    gtd['date_prec'] = date_prec.astype('int8')
 
     # Select relevant variables
 
     gtd = gtd[[
+        'event_id',
         'year',
         'month',
         'day',
@@ -197,6 +231,116 @@ def get_gtd_df(path):
     return gtd
 
 
+def select_dates(df, startdate=None, enddate=None):
+    """
+    Ne garde que les évènements ayant commencé entre startdate et enddate.
+    """
+    if startdate is not None:
+        df = df[startdate <= df['date_start']]
+    if enddate is not None:
+        df = df[df['date_start'] <= enddate]
+    return df
+
+
+def concat_chunks(chunks):
+    """
+    Concatène les paquets lus. Les paquets vidés par les filtres sont écartés :
+    leurs colonnes (souvent de type object) changeraient sinon les types du résultat.
+    """
+    non_empty = [chunk for chunk in chunks if len(chunk) > 0]
+    return pd.concat(non_empty or chunks[:1])
+
+
+def to_categories(df, columns):
+    """
+    Convertit les colonnes textuelles répétitives en catégories.
+    """
+    for c in columns:
+        df[c] = df[c].astype('category')
+    return df
+
+
+###########################
+# Columnar cache
+###########################
+
+# Relire ged.csv et gtd.csv à chaque lancement prend plusieurs dizaines de secondes.
+# On enregistre donc la base nettoyée au format Parquet, dans un dossier cache/ à côté
+# du .csv, sous un nom qui dépend de l'empreinte du fichier source : dès que le .csv
+# change, l'ancien cache n'est plus utilisé (et il est supprimé). cache_version est
+# à incrémenter dès que le nettoyage change (colonnes, types, filtres), pour que les
+# caches écrits par l'ancien code ne soient plus servis.
+
+cache_version = 3
+
+def source_hash(path):
+    """
+    Empreinte d'un fichier source (chemin, taille et date de modification).
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}-{stat.st_size}-{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def load_cached(path, loader, columns=None, startdate=None, enddate=None, countries=None):
+    """
+    Charge une base nettoyée par loader(path), en passant par le cache Parquet.
+
+    Parameters
+    ----------
+    path : str
+        Chemin du .csv source.
+    loader : function
+        get_ged_df ou get_gtd_df.
+    columns : list, optionnel
+        Les seules colonnes à lire dans le cache.
+    startdate, enddate, countries : optionnels
+        Filtres appliqués dès la lecture (du cache, ou du .csv sans cache).
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        # Pas de Parquet sans pyarrow : on relit le .csv, en filtrant chaque paquet
+        df = loader(path, startdate, enddate, countries)
+        return df if columns is None else df[columns]
+
+    cache_dir = os.path.join(os.path.dirname(path), "cache")
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f"{name}_{source_hash(path)}_v{cache_version}.parquet")
+
+    if os.path.exists(cache_path):
+        filters = []
+        if countries is not None:
+            filters.append(('country', 'in', list(countries)))
+        if startdate is not None:
+            filters.append(('date_start', '>=', pd.Timestamp(startdate)))
+        if enddate is not None:
+            filters.append(('date_start', '<=', pd.Timestamp(enddate)))
+        return pd.read_parquet(cache_path, columns=columns, filters=filters or None, memory_map=True)
+
+    df = loader(path).reset_index(drop=True)
+
+    # Ecrit dans un fichier temporaire puis renommé : un lancement interrompu
+    # ne laisse jamais un cache incomplet sous le nom attendu
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+
+    # On supprime ensuite les caches périmés du même fichier (et de lui seul :
+    # le cache de "ged_2021.csv" commence aussi par "ged_")
+    stale = re.compile(re.escape(name) + r"_[0-9a-f]{16}_v\d+\.parquet")
+    for f in os.listdir(cache_dir):
+        if stale.fullmatch(f) and f != os.path.basename(cache_path):
+            os.remove(os.path.join(cache_dir, f))
+
+    if countries is not None:
+        df = df[df['country'].isin(countries)]
+    df = select_dates(df, startdate, enddate)
+
+    return df if columns is None else df[columns]
+
+
 ###########################
 # Data selection
 ###########################
@@ -219,12 +363,21 @@ def select(ged, gtd, startdate, enddate, countries, perpetrators):
 
 def grid(df, h3_level):
     """
-    Ajoute les cellules H3.
+    Ajoute les cellules H3, sous forme d'identifiants entiers (uint64).
+
+    Beaucoup d'évènements partagent les mêmes coordonnées (centroïdes de villages,
+    de districts...) : on ne calcule la cellule qu'une fois par couple
+    (latitude, longitude) distinct, d'un seul appel vectorisé si possible.
     """
-    def lat_lng_to_h3(row):
-        return h3.geo_to_h3(row.latitude, row.longitude, h3_level)
-    
-    df['h3'] = df.apply(lat_lng_to_h3, axis = 1)
+    coords = df[['latitude', 'longitude']].to_numpy(dtype='float64')
+    unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+
+    if h3_vect is not None:
+        cells = h3_vect.geo_to_h3(unique[:, 0], unique[:, 1], h3_level)
+    else:
+        cells = [h3.string_to_h3(h3.geo_to_h3(lat, lng, h3_level)) for lat, lng in unique]
+
+    df['h3'] = np.asarray(cells, dtype='uint64')[inverse.ravel()]
 
 
 ###########################
@@ -237,8 +390,8 @@ def get_events(p: prm.Parameters):
     parmi les bases GED et GTD correspondants aux paramètres p.
     """
     
-    ged = get_ged_df(p.ged_path)
-    gtd = get_gtd_df(p.gtd_path)
+    ged = load_cached(p.ged_path, get_ged_df, startdate=p.startdate, enddate=p.enddate, countries=p.countries)
+    gtd = load_cached(p.gtd_path, get_gtd_df, startdate=p.startdate, enddate=p.enddate, countries=p.countries)
 
     df = select(ged, gtd, p.startdate, p.enddate, p.countries, p.perpetrators)
     grid(df, p.h3_level)
@@ -1,7 +1,20 @@
 # -*- coding: utf-8 -*-
+import io
+import os
+import json
+import tempfile
 import numpy as np
+import pandas as pd
+import h3
 import unittest
-from hmm import viterbi 
+from unittest import mock
+import exposure
+import exposure_numba
+import grid
+import observation
+import precleaning
+from hmm import get_pi, get_states, hidden_states, viterbi, viterbi_log, viterbi_batch, forward_backward_batch, baum_welch, OnlineViterbi, t, e
+from hmm_numba import viterbi_log_numba
 
 observable_states= ['O1', 'O2', 'O3', 'O4']
 hidden_states = ['R', 'DR', 'D', 'DG', 'G']
@@ -55,5 +68,637 @@ class TestViterbi(unittest.TestCase):
         np.testing.assert_array_equal(result2, viterbi(pi, t2, e2, obs2)[0])
 
 
+    ###############################
+    # Test de Viterbi vectorisé   #
+    ###############################
+
+    def test_viterbi_batch(self):
+        rng = np.random.default_rng(0)
+        obs = rng.integers(0, 4, size=(50, 24)).astype('int8')
+
+        paths = viterbi_batch(pi, t, e, obs)
+        paths_log = viterbi_batch(pi, t, e, obs, log=True)
+
+        self.assertEqual(paths.dtype, np.int8)
+        for c in range(obs.shape[0]):
+            np.testing.assert_array_equal(viterbi(pi, t, e, obs[c])[0], paths[c])
+            np.testing.assert_array_equal(viterbi_log(pi, t, e, obs[c])[0], paths_log[c])
+
+        np.testing.assert_array_equal(paths_log, viterbi_log_numba(pi, t, e, obs))
+
+        # Le moteur Numba décode avec le même algorithme que "numpy_log"
+        obs_df = pd.DataFrame(obs)
+        pd.testing.assert_frame_equal(get_states(obs_df, pi, engine="numba"), get_states(obs_df, pi, engine="numpy_log"))
+
+        # Etats en Categorical (codes int8), écrits avec leurs noms dans le .csv
+        states_df = get_states(obs_df, pi)
+        self.assertEqual(states_df.shape, (obs.shape[1], obs.shape[0]))
+        self.assertTrue((states_df.dtypes == "category").all())
+        np.testing.assert_array_equal(states_df[0].cat.codes.to_numpy(), paths[0])
+        labels = pd.read_csv(io.StringIO(states_df.to_csv()), index_col=0)
+        np.testing.assert_array_equal(labels.iloc[:, 0].to_numpy(), np.array(hidden_states)[paths[0]])
+
+        # Par paquets, et avec le treillis et le backtracing complets
+        np.testing.assert_array_equal(paths, viterbi_batch(pi, t, e, obs, block_size=7))
+        full, treillis, backtracing = viterbi_batch(pi, t, e, obs, diagnostics=True)
+        np.testing.assert_array_equal(paths, full)
+        _, treillis_0, backtracing_0 = viterbi(pi, t, e, obs[0])
+        np.testing.assert_array_equal(treillis_0, treillis[0])
+        np.testing.assert_array_equal(backtracing_0, backtracing[0])
+
+    def test_online_viterbi(self):
+        # Avec un retard au moins égal à T, on retrouve le chemin complet,
+        # y compris le choix entre chemins ex aequo
+        for country in ['Iraq', 'Nigeria']:
+            for seed in range(5):
+                for T in [24, 300]:
+                    rng = np.random.default_rng(seed)
+                    obs = rng.integers(0, 4, size=(40, T)).astype('int8')
+                    decoder = OnlineViterbi(get_pi(country), 40, lag=T)
+                    for k in range(T):
+                        self.assertIsNone(decoder.update(obs[:, k]))
+                    np.testing.assert_array_equal(viterbi_batch(get_pi(country), t, e, obs, log=True), decoder.flush(),
+                                                  err_msg=f"{country} {seed} {T}")
+
+        rng = np.random.default_rng(3)
+        obs = rng.integers(0, 4, size=(30, 24)).astype('int8')
+        paths_log = viterbi_batch(pi, t, e, obs, log=True)
+
+        # Avec un retard plus court, chaque décision arrive lag instants plus tard,
+        # et le décodeur peut être enregistré puis rechargé en cours de route
+        decoder = OnlineViterbi(pi, 30, lag=6)
+        emitted = []
+        for k in range(24):
+            if k == 12:
+                decoder.save('online_viterbi_test.npz')
+                decoder = OnlineViterbi.load('online_viterbi_test.npz')
+            states = decoder.update(obs[:, k])
+            if states is not None:
+                emitted.append(states)
+        os.remove('online_viterbi_test.npz')
+        online = np.concatenate([np.array(emitted).T, decoder.flush()], axis=1)
+
+        self.assertEqual(online.shape, obs.shape)
+        # Les 6 derniers états sont décidés avec toute l'information disponible
+        np.testing.assert_array_equal(paths_log[:, -6:], online[:, -6:])
+
+
+
+class TestForwardBackward(unittest.TestCase):
+
+    def test_posteriors(self):
+        rng = np.random.default_rng(1)
+        obs = rng.integers(0, 4, size=(20, 8)).astype('int8')
+
+        posteriors, log_likelihood = forward_backward_batch(pi, t, e, obs, block_size=6)
+
+        # Calcul direct, sans normalisation, cellule par cellule
+        for c in range(obs.shape[0]):
+            T = obs.shape[1]
+            alpha = np.zeros((T, 5))
+            beta = np.ones((T, 5))
+            alpha[0] = np.array(pi) * e[:, obs[c, 0]]
+            for k in range(1, T):
+                alpha[k] = (alpha[k-1] @ t) * e[:, obs[c, k]]
+            for k in range(T-2, -1, -1):
+                beta[k] = t @ (e[:, obs[c, k+1]] * beta[k+1])
+            likelihood = alpha[T-1].sum()
+
+            np.testing.assert_allclose(posteriors[c], alpha * beta / likelihood, rtol=1e-5)
+            np.testing.assert_allclose(log_likelihood[c], np.log(likelihood))
+
+        self.assertEqual(posteriors.dtype, np.float32)
+
+        # Taille des paquets déduite de la mémoire accordée (ici 3 cellules par paquet)
+        small, _ = forward_backward_batch(pi, t, e, obs, memory=3 * 2 * 8 * 5 * 8)
+        np.testing.assert_array_equal(small, posteriors)
+
+    def test_baum_welch(self):
+        # Observations simulées à partir de t et e
+        rng = np.random.default_rng(2)
+        n_cells, T = 200, 30
+        states = np.zeros((n_cells, T), dtype=int)
+        states[:, 0] = rng.choice(5, size=n_cells, p=pi)
+        for k in range(1, T):
+            states[:, k] = [rng.choice(5, p=t[s]) for s in states[:, k-1]]
+        obs = np.array([[rng.choice(4, p=e[s]) for s in row] for row in states], dtype='int8')
+
+        pi2, t2, e2, log_likelihoods = baum_welch(obs, pi, t, e, max_iter=10, block_size=64, verbose=False)
+
+        # La log-vraisemblance ne décroît pas, les paramètres restent stochastiques
+        self.assertTrue(np.all(np.diff(log_likelihoods) >= -1e-8))
+        np.testing.assert_allclose(pi2.sum(), 1)
+        np.testing.assert_allclose(t2.sum(axis=1), 1)
+        np.testing.assert_allclose(e2.sum(axis=1), 1)
+
+        # Même résultat avec des paquets déduits de la mémoire accordée
+        pi3, t3, e3, _ = baum_welch(obs, pi, t, e, max_iter=10, verbose=False, memory=50 * 3 * T * 5 * 8)
+        np.testing.assert_allclose(t3, t2)
+        np.testing.assert_allclose(e3, e2)
+
+
+
+class TestExposure(unittest.TestCase):
+
+    def setUp(self):
+        # Quelques cellules autour de Mossoul et des évènements tirés au hasard autour
+        rng = np.random.default_rng(4)
+        self.cells = sorted(h3.k_ring(h3.geo_to_h3(36.34, 43.13, 5), 3))
+        self.cells_coord = np.array([h3.h3_to_geo(c) for c in self.cells])
+
+        n_events = 60
+        self.events_coord = np.column_stack([36.34 + rng.normal(0, 0.2, n_events),
+                                             43.13 + rng.normal(0, 0.2, n_events)])
+        self.events_h3 = np.array([h3.string_to_h3(h3.geo_to_h3(lat, lng, 5)) for lat, lng in self.events_coord], dtype='uint64')
+
+        self.events_days = 14000 + rng.integers(0, 365, n_events)
+        self.dates_days = 14000 + np.arange(0, 400, 30)
+        self.wa_table = exposure_numba.age_weights(self.events_days, self.dates_days)
+
+    def dense_exposure(self):
+        # Calcul direct, sur toutes les paires cellule-évènement
+        res = np.zeros((len(self.cells), len(self.dates_days)))
+        for i, cell in enumerate(self.cells):
+            ring = [h3.string_to_h3(c) for c in h3.k_ring(cell, 2)]
+            for j, h in enumerate(self.events_h3):
+                if h in ring:
+                    lat1, lng1 = self.cells_coord[i]
+                    lat2, lng2 = self.events_coord[j]
+                    w = exposure_numba.wd(exposure_numba.harvesine(lng1, lat1, lng2, lat2))
+                    for d, date in enumerate(self.dates_days):
+                        res[i, d] += w * exposure_numba.wa(exposure_numba.day * (date - self.events_days[j]))
+        return res
+
+    def test_sparse_exposure(self):
+        # La table couvre l'écart entre le premier évènement et la dernière date, pas plus
+        self.assertEqual(len(self.wa_table), self.dates_days.max() - self.events_days.min() + 1)
+        self.assertEqual(len(exposure_numba.age_weights(np.zeros(0, dtype='int64'), self.dates_days)), 1)
+
+        indptr, indices = exposure_numba.get_incidence(self.cells, self.events_h3)
+        distances = exposure_numba.calc_distances(self.cells_coord, self.events_coord, indptr, indices)
+        indices, distances = exposure_numba.sort_incidence_by_date(indptr, indices, distances, self.events_days)
+        exposure = exposure_numba.get_exposure_raw(self.events_days, indptr, indices, distances, self.dates_days, self.wa_table)
+
+        np.testing.assert_allclose(exposure, self.dense_exposure(), rtol=1e-12)
+
+        ev_indptr, ev_cells, ev_distances = exposure_numba.transpose_incidence(indptr, indices, distances, len(self.events_days))
+        scatter = exposure_numba.get_exposure_scatter(self.events_days, ev_indptr, ev_cells, ev_distances, self.dates_days, self.wa_table, len(self.cells))
+        np.testing.assert_allclose(scatter, exposure, rtol=1e-12)
+
+        means = exposure_numba.mean_exposure(self.events_days, indptr, indices, distances, self.dates_days, self.wa_table)
+        np.testing.assert_allclose(means, exposure.mean(axis=0), rtol=1e-12)
+
+        # Fenêtre d'âges limitée par une tolérance sur wa
+        tol = 1e-2
+        horizon = exposure_numba.age_horizon(tol)
+        self.assertLess(exposure_numba.wa(horizon * exposure_numba.day), tol)
+        self.assertGreaterEqual(exposure_numba.wa((horizon - 1) * exposure_numba.day), tol)
+
+        wa_table = exposure_numba.age_weights(self.events_days, self.dates_days, tol)
+        self.assertEqual(len(wa_table), horizon + 1)
+        windowed = exposure_numba.get_exposure_raw(self.events_days, indptr, indices, distances, self.dates_days, wa_table)
+        # Chaque évènement ignoré pesait moins de wd x tol
+        rows = np.repeat(np.arange(len(self.cells)), np.diff(indptr))
+        bound = tol * np.bincount(rows, weights=exposure_numba.wd(distances), minlength=len(self.cells))[:, None]
+        self.assertTrue(np.all(np.abs(windowed - exposure) <= bound))
+        self.assertTrue(np.any(windowed != exposure))
+
+        scatter = exposure_numba.get_exposure_scatter(self.events_days, ev_indptr, ev_cells, ev_distances, self.dates_days, wa_table, len(self.cells))
+        np.testing.assert_allclose(scatter, windowed, rtol=1e-12)
+        means = exposure_numba.mean_exposure(self.events_days, indptr, indices, distances, self.dates_days, wa_table)
+        np.testing.assert_allclose(means, windowed.mean(axis=0), rtol=1e-12)
+
+    def test_exposure_with_cas(self):
+        rng = np.random.default_rng(5)
+        n_events = len(self.events_h3)
+        fatalities = np.where(rng.random(n_events) < 0.2, np.nan, rng.integers(0, 30, n_events))
+        events = pd.DataFrame({'latitude': self.events_coord[:, 0], 'longitude': self.events_coord[:, 1], 'h3': self.events_h3,
+                               'type': "terrorism", 'fatalities': fatalities,
+                               'date_start': pd.to_datetime(self.events_days, unit="D")})
+
+        indptr, indices = exposure_numba.get_incidence(self.cells, self.events_h3)
+        distances = exposure_numba.calc_distances(self.cells_coord, self.events_coord, indptr, indices)
+        indices, distances = exposure_numba.sort_incidence_by_date(indptr, indices, distances, self.events_days)
+        result = exposure_numba.get_exposure_with_cas_raw(self.events_days, fatalities, indptr, indices, distances, self.dates_days, self.wa_table)
+
+        # Version pandas (lente), sur une partie des cellules et des dates
+        long_distances = exposure.calc_distances(self.cells, events)
+        dates = pd.to_datetime(self.dates_days, unit="D")
+        for i in range(0, len(self.cells), 3):
+            cell = self.cells[i]
+            for d in range(0, len(dates), 2):
+                date = dates[d]
+                expected = exposure.cell_exposure_at_t_with_cas(events, "terrorism", cell, date, long_distances)
+                np.testing.assert_allclose(result[i, d], expected, rtol=1e-10, err_msg=f"{cell} {date}")
+
+        self.assertTrue(np.isnan(result).any())
+
+    def test_multi_type_exposure(self):
+        types = ["conventional", "terrorism", "other"]
+        events = pd.DataFrame({'latitude': self.events_coord[:, 0], 'longitude': self.events_coord[:, 1], 'h3': self.events_h3,
+                               'type': np.array(types)[np.arange(len(self.events_h3)) % 3],
+                               'date_start': pd.to_datetime(self.events_days, unit="D")})
+        date_range = self.dates_days * exposure_numba.day
+
+        events_days, events_types, indptr, indices, distances, dates_days, wa_table = exposure_numba.prepare_exposures(
+            events, types[:2], self.cells, self.cells_coord, date_range)
+        result = exposure_numba.get_exposures_raw(events_days, events_types, 2, indptr, indices, distances, dates_days, wa_table)
+        self.assertEqual(result.shape, (2, len(self.cells), len(date_range)))
+
+        # Même résultat qu'un calcul séparé pour chaque type
+        for k, attack_type in enumerate(types[:2]):
+            inputs = exposure_numba.prepare_exposure(events, attack_type, self.cells, self.cells_coord, date_range)
+            np.testing.assert_allclose(result[k], exposure_numba.get_exposure_raw(*inputs), rtol=1e-12)
+
+    def test_update_exposure(self):
+        events = pd.DataFrame({'event_id': [f"ged-{i}" for i in range(len(self.events_h3))],
+                               'latitude': self.events_coord[:, 0], 'longitude': self.events_coord[:, 1], 'h3': self.events_h3,
+                               'type': "terrorism", 'date_start': pd.to_datetime(self.events_days, unit="D")})
+        date_range = self.dates_days * exposure_numba.day
+
+        def run(events, date_range, path=None):
+            inputs = exposure_numba.prepare_exposure(events, "terrorism", self.cells, self.cells_coord, date_range)
+            if path is None:
+                return exposure_numba.exposure_kernel(*inputs)
+            return exposure_numba.update_exposure(events, self.cells, date_range, path, *inputs).to_numpy()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "exposure.csv")
+            first = run(events.iloc[:50], date_range[:8], path)
+            np.testing.assert_array_equal(first, run(events.iloc[:50], date_range[:8]))
+
+            # Nouvelles dates, évènements ajoutés, un évènement déplacé dans le temps, un autre supprimé
+            updated = events.drop(index=3)
+            updated.loc[7, 'date_start'] += pd.Timedelta("20 days")
+            result = run(updated, date_range, path)
+            np.testing.assert_allclose(result, run(updated, date_range), rtol=1e-12)
+
+            saved = pd.read_csv(path, index_col=0)
+            self.assertEqual(saved.shape, (len(self.cells), len(date_range)))
+            np.testing.assert_allclose(saved.to_numpy(), result, rtol=1e-12)
+
+            # Sans changement, le fichier est relu tel quel
+            np.testing.assert_array_equal(run(updated, date_range, path), result)
+
+    def test_pandas_distances(self):
+        events = pd.DataFrame({'latitude': self.events_coord[:, 0], 'longitude': self.events_coord[:, 1], 'h3': self.events_h3},
+                              index=np.zeros(len(self.events_h3), dtype=int)) # index non unique, comme après precleaning.select
+        distances = exposure.calc_distances(self.cells, events)
+
+        # Tous les couples (cellule, évènement du 2-ring), et eux seuls
+        expected = {}
+        for i, cell in enumerate(self.cells):
+            ring = [h3.string_to_h3(c) for c in h3.k_ring(cell, 2)]
+            for j, h in enumerate(self.events_h3):
+                if h in ring:
+                    lat1, lng1 = self.cells_coord[i]
+                    lat2, lng2 = self.events_coord[j]
+                    expected[(cell, j)] = exposure.wd(exposure.harvesine(lng1, lat1, lng2, lat2))
+
+        self.assertEqual(len(distances), len(expected))
+        for cell, event, w in distances.itertuples(index=False):
+            self.assertAlmostEqual(w, expected[(cell, event)], places=12)
+
+
+
+class TestObservation(unittest.TestCase):
+
+    def test_probabilities(self):
+        rng = np.random.default_rng(5)
+        E = pd.DataFrame(rng.exponential(2, size=(40, 12)) * (rng.random((40, 12)) < 0.5))
+        E[3] = 0.
+
+        P = observation.get_probabilities(E)
+
+        for c in E.columns:
+            l = E[c].mean()
+            np.testing.assert_allclose(P[c], E[c].apply(lambda x: observation.poisson(x, l)), rtol=1e-10)
+
+        # Pas de débordement pour les grandes expositions
+        self.assertTrue(np.isfinite(observation.probabilities(np.array([[500.], [700.]]))).all())
+        self.assertEqual(observation.get_probabilities(E, dtype='float32').dtypes.iloc[0], np.float32)
+
+    def test_observation(self):
+        rng = np.random.default_rng(6)
+        shape = (30, 10)
+        Et = pd.DataFrame(rng.exponential(1, shape) * (rng.random(shape) < 0.5))
+        Ec = pd.DataFrame(rng.exponential(1, shape) * (rng.random(shape) < 0.5))
+        Et.iloc[0, 0] = 0.005 # tronquée à 0
+        T = observation.get_probabilities(Et)
+        C = observation.get_probabilities(Ec)
+        m, xs = 0.15, 0.01
+
+        O = observation.get_observation(Et, Ec, C, T, m, xs)
+
+        # Règles appliquées case par case
+        for i in range(shape[0]):
+            for d in range(shape[1]):
+                et = 0 if Et.iloc[i, d] < xs else Et.iloc[i, d]
+                ec = 0 if Ec.iloc[i, d] < xs else Ec.iloc[i, d]
+                c, t = C.iloc[i, d], T.iloc[i, d]
+                if et == 0 and ec == 0:
+                    expected = 0
+                elif abs(t - c) <= m:
+                    expected = 2
+                elif c > t:
+                    expected = 1
+                else:
+                    expected = 3
+                self.assertEqual(O.iloc[i, d], expected)
+
+        self.assertEqual(O.dtypes.iloc[0], np.int8)
+
+
+class TestGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dirs = grid.geojson_dir, grid.grid_dir
+        grid.geojson_dir = self.tmp.name
+        grid.grid_dir = os.path.join(self.tmp.name, "grids")
+        square = [[[42.6, 35.9], [43.7, 35.9], [43.7, 36.8], [42.6, 36.8], [42.6, 35.9]]]
+        self.write("Testland", {"type": "Polygon", "coordinates": square})
+
+    def write(self, country, geometry):
+        with open(grid.geojson_path(country), "w") as f:
+            json.dump({"type": "FeatureCollection", "features": [
+                {"type": "Feature", "properties": {}, "geometry": geometry}]}, f)
+
+    def tearDown(self):
+        grid.geojson_dir, grid.grid_dir = self.dirs
+        grid._grids.clear()
+        self.tmp.cleanup()
+
+    def test_grid_cache(self):
+        cells = grid.json_to_h3("Testland", 5)
+        self.assertEqual(set(cells), set(grid.polyfill("Testland", 5)))
+        self.assertEqual(len(os.listdir(grid.grid_dir)), 1)
+
+        # Relecture depuis le disque
+        grid._grids.clear()
+        ids, centroids, boundaries = grid.load_grid("Testland", 5)
+        self.assertEqual(ids.dtype, np.uint64)
+        self.assertEqual([h3.h3_to_string(int(i)) for i in ids], cells)
+        np.testing.assert_allclose(centroids[0], h3.h3_to_geo(cells[0]))
+
+        gdf = grid.country_grid("Testland", 5)
+        self.assertEqual(len(gdf), len(cells))
+        self.assertTrue(gdf.geometry.is_valid.all())
+
+    def test_multipolygon(self):
+        def square(lng, lat, size):
+            return [[lng, lat], [lng + size, lat], [lng + size, lat + size], [lng, lat + size], [lng, lat]]
+
+        # Une île, et un territoire percé d'un trou
+        island = [square(45, 36, 0.5)]
+        pierced = [square(42.6, 35.9, 1.1), square(42.9, 36.2, 0.4)]
+        self.write("Multiland", {"type": "MultiPolygon", "coordinates": [island, pierced]})
+
+        cells = set(grid.json_to_h3("Multiland", 5))
+        self.assertTrue(h3.geo_to_h3(36.25, 45.25, 5) in cells)
+        self.assertFalse(h3.geo_to_h3(36.4, 43.1, 5) in cells)
+        self.assertTrue(h3.geo_to_h3(36, 42.7, 5) in cells)
+
+        # Les threads de Numba tournent déjà quand les processus sont lancés
+        viterbi_log_numba(np.full(5, 0.2), t, e, np.zeros((4, 10), dtype='int8'))
+
+        # Les cellules communes aux deux pays ne sont comptées qu'une fois
+        grid._grids.clear()
+        for f in os.listdir(grid.grid_dir):
+            os.remove(os.path.join(grid.grid_dir, f))
+        ids, centroids, boundaries = grid.get_grid(["Testland", "Multiland"], 5)
+        expected = cells | set(grid.json_to_h3("Testland", 5))
+        self.assertEqual(len(ids), len(expected))
+        self.assertTrue(np.all(ids[1:] > ids[:-1]))
+        self.assertEqual(set(h3.h3_to_string(int(i)) for i in ids), expected)
+        self.assertEqual(len(centroids), len(ids))
+        self.assertEqual(len(boundaries), len(ids))
+
+        # Grilles déjà sur le disque : lues dans le processus courant, sans en lancer d'autres
+        grid._grids.clear()
+        with mock.patch.object(grid, "ProcessPoolExecutor", side_effect=AssertionError("process pool started")):
+            cached = grid.get_grid(["Testland", "Multiland"], 5)
+        np.testing.assert_array_equal(cached[0], ids)
+
+    def test_adaptive(self):
+        class P:
+            countries, h3_level, n_threads = ["Testland"], 6, None
+            startdate, enddate = "2015-01-01", "2015-06-30"
+
+        # Evènements regroupés dans un coin du pays
+        rng = np.random.default_rng(3)
+        n = 40
+        events = pd.DataFrame({'latitude': rng.uniform(35.95, 36.1, n), 'longitude': rng.uniform(42.65, 42.8, n),
+                               'type': rng.choice(["conventional", "terrorism"], n),
+                               'date_start': pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 150, n), unit="D")})
+        events['h3'] = np.array([h3.string_to_h3(h3.geo_to_h3(lat, lng, 6)) for lat, lng in events[['latitude', 'longitude']].to_numpy()], dtype='uint64')
+
+        full = {a: exposure_numba.get_exposure(events, a, P, "MS") for a in ["conventional", "terrorism"]}
+        compact = {a: exposure_numba.get_exposure(events, a, P, "MS", adaptive=True) for a in ["conventional", "terrorism"]}
+        self.assertLess(len(compact["terrorism"]), len(full["terrorism"]) / 2)
+
+        # Même exposition une fois remise à la pleine résolution
+        for a in full:
+            pd.testing.assert_frame_equal(grid.uncompact_df(compact[a], 6), full[a])
+
+        # Probabilités, observations et états identiques
+        weights = grid.cell_weights(compact["terrorism"].index, 6)
+        self.assertEqual(weights.sum(), len(full["terrorism"]))
+        O_full = observation.get_observation(full["terrorism"], full["conventional"],
+                                             observation.get_probabilities(full["conventional"]),
+                                             observation.get_probabilities(full["terrorism"]), 0.15, 0.01)
+        O = observation.get_observation(compact["terrorism"], compact["conventional"],
+                                        observation.get_probabilities(compact["conventional"], weights=weights),
+                                        observation.get_probabilities(compact["terrorism"], weights=weights), 0.15, 0.01)
+        pd.testing.assert_frame_equal(grid.uncompact_df(O, 6), O_full)
+
+        fused = exposure_numba.get_observation_fused(events, P, "MS", 0.15, 0.01, adaptive=True)
+        pd.testing.assert_frame_equal(fused, O)
+
+        states = grid.uncompact_df(get_states(O, pi), 6, axis=1)
+        states_full = get_states(O_full, pi, dedupe=False)
+        pd.testing.assert_frame_equal(states, states_full)
+
+        # Expositions écrites paquet par paquet : mêmes fichiers que sans grille adaptative
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = {a: os.path.join(tmp, f"{a}.csv") for a in full}
+            exposure_numba.get_observation_fused(events, P, "MS", 0.15, 0.01, block_size=7, exposure_paths=paths, adaptive=True)
+            for a in full:
+                written = pd.read_csv(paths[a], index_col=0, float_precision="round_trip")
+                self.assertEqual(list(written.index), list(full[a].index))
+                np.testing.assert_array_equal(written.to_numpy(), full[a].to_numpy())
+
+
+def write_ged(path, n, seed):
+    """
+    Petite base GED synthétique (avec une colonne inutile, non lue).
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2014-01-01") + pd.to_timedelta(rng.integers(0, 1000, n), unit="D")
+    pd.DataFrame({
+        'id': np.arange(n),
+        'type_of_violence': rng.integers(1, 4, n),
+        'side_b': rng.choice(["IS", "PKK", "AQIM"], n),
+        'where_prec': rng.integers(1, 7, n),
+        'latitude': rng.uniform(30, 37, n),
+        'longitude': rng.uniform(38, 48, n),
+        'country': rng.choice(["Iraq", "Syria", "Mali"], n),
+        'date_prec': rng.integers(1, 6, n),
+        'date_start': start.strftime("%Y-%m-%d"),
+        'date_end': (start + pd.to_timedelta(rng.integers(0, 3, n), unit="D")).strftime("%Y-%m-%d"),
+        'best': rng.integers(0, 50, n),
+        'source_article': "...",
+    }).to_csv(path, index=False)
+
+
+def write_gtd(path, n, seed):
+    """
+    Petite base GTD synthétique, avec des jours et des mois inconnus (0).
+    """
+    rng = np.random.default_rng(seed)
+    extended = rng.integers(0, 2, n)
+    resolution = pd.Series(pd.Timestamp("2016-06-01") + pd.to_timedelta(rng.integers(0, 30, n), unit="D")).dt.strftime("%Y-%m-%d")
+    pd.DataFrame({
+        'eventid': np.arange(n),
+        'iyear': rng.integers(2013, 2017, n),
+        'imonth': rng.integers(0, 13, n),
+        'iday': rng.integers(0, 29, n),
+        'approxdate': np.where(rng.random(n) < 0.3, "around", ""),
+        'extended': extended,
+        'resolution': np.where(extended == 1, resolution, ""),
+        'country_txt': rng.choice(["Iraq", "Syria", "Mali"], n),
+        'latitude': rng.uniform(30, 37, n),
+        'longitude': rng.uniform(38, 48, n),
+        'specificity': rng.integers(1, 6, n),
+        'doubtterr': rng.choice([0, 1, -9], n),
+        'attacktype1': rng.integers(1, 10, n),
+        'attacktype1_txt': rng.choice(["Bombing", "Armed Assault"], n),
+        'targtype1': rng.integers(1, 8, n),
+        'gname': rng.choice(["IS", "Unknown"], n),
+        'nkill': np.where(rng.random(n) < 0.1, np.nan, rng.integers(0, 20, n)),
+        'summary': "...",
+    }).to_csv(path, index=False)
+
+
+class TestPrecleaning(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ged_path = os.path.join(self.tmp.name, "ged.csv")
+        self.gtd_path = os.path.join(self.tmp.name, "gtd.csv")
+        write_ged(self.ged_path, 300, 0)
+        write_gtd(self.gtd_path, 600, 0)
+
+    def test_chunks(self):
+        countries = ["Iraq", "Syria"]
+        startdate, enddate = "2014-06-01", "2016-03-01"
+        types = {'ged': {'date_prec': np.int8, 'prec_tax': np.int8, 'event_tax': np.int8, 'fatalities': np.int32},
+                 'gtd': {'date_prec': np.int8, 'event_tax': np.int8, 'year': np.int16}}
+
+        for name, loader, path in [('ged', precleaning.get_ged_df, self.ged_path), ('gtd', precleaning.get_gtd_df, self.gtd_path)]:
+            # Petits paquets filtrés dès leur lecture, ou base entière filtrée après coup
+            chunked = loader(path, startdate, enddate, countries, chunksize=37).reset_index(drop=True)
+            full = loader(path, chunksize=10**6)
+            full = full[full['country'].isin(countries)]
+            full = precleaning.select_dates(full, startdate, enddate).reset_index(drop=True)
+
+            self.assertGreater(len(chunked), 0)
+            pd.testing.assert_frame_equal(chunked, full, check_categorical=False)
+
+            # Les types compacts survivent à la concaténation des paquets
+            for column, dtype in types[name].items():
+                self.assertEqual(chunked[column].dtype, dtype, (name, column))
+            for column in ['country', 'perpetrator', 'type']:
+                self.assertEqual(chunked[column].dtype, 'category', (name, column))
+
+    def test_gtd_date_prec(self):
+        # Version d'origine : colonnes dérivées sur toute la base, date_prec
+        # ligne par ligne, puis filtres
+        raw = pd.read_csv(self.gtd_path)
+        self.assertTrue(((raw['iday'] == 0) | (raw['imonth'] == 0)).any())
+
+        gtd = raw.rename(columns = {'iyear' : 'year', 'imonth' : 'month', 'iday' : 'day'})
+        gtd.loc[gtd['day'] == 0, 'day'] = 1
+        gtd.loc[gtd['month'] == 0, 'month'] = 1
+        gtd['date_start'] = pd.to_datetime(gtd[['year', 'month', 'day']])
+        gtd['date_end'] = pd.to_datetime(gtd['resolution'])
+        gtd['duration'] = gtd['date_end'] - gtd['date_start'] + pd.Timedelta("1 days")
+        gtd.loc[gtd['extended'] == 0, 'duration'] = pd.Timedelta("1 days")
+
+        def calc_date_prec(row):
+            date_prec = np.NaN
+            if row['approxdate'] == "":
+                date_prec = 1
+            else:
+                date_prec = 2
+            if row['month'] != 0 and row['day'] == 0:
+                date_prec = 3
+            if row['month'] == 0:
+                date_prec = 5
+            return date_prec
+
+        gtd['date_prec'] = gtd.apply(calc_date_prec, axis = 1)
+        expected = gtd[(gtd['targtype1'] != 4) & (gtd['doubtterr'] == 0) & gtd['specificity'].isin([1, 2, 3])]
+        expected = expected.reset_index(drop=True)
+
+        result = precleaning.get_gtd_df(self.gtd_path, chunksize=50).reset_index(drop=True)
+
+        # Les évènements aux jours ou mois inconnus sont bien gardés
+        zeros = raw.loc[(raw['iday'] == 0) | (raw['imonth'] == 0), 'eventid']
+        self.assertTrue(expected['eventid'].isin(zeros).any())
+
+        self.assertEqual(len(result), len(expected))
+        for column in ['year', 'month', 'day', 'date_start', 'date_end', 'date_prec', 'duration', 'latitude', 'longitude']:
+            np.testing.assert_array_equal(result[column].to_numpy(), expected[column].to_numpy(), column)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cache(self):
+        cache_dir = os.path.join(self.tmp.name, "cache")
+        expected = precleaning.get_ged_df(self.ged_path).reset_index(drop=True)
+
+        # Premier chargement : le cache est écrit, sous un nom qui contient cache_version
+        df = precleaning.load_cached(self.ged_path, precleaning.get_ged_df)
+        pd.testing.assert_frame_equal(df, expected)
+        files = os.listdir(cache_dir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(f"_v{precleaning.cache_version}.parquet"))
+
+        # Relecture depuis le cache, avec les filtres
+        pd.testing.assert_frame_equal(precleaning.load_cached(self.ged_path, precleaning.get_ged_df), expected, check_categorical=False)
+        filtered = precleaning.load_cached(self.ged_path, precleaning.get_ged_df, startdate="2015-01-01", countries=["Iraq"])
+        self.assertEqual(len(filtered), ((expected['country'] == "Iraq") & (expected['date_start'] >= "2015-01-01")).sum())
+
+        # Cache d'un autre fichier dont le nom commence pareil, dans le même dossier
+        other_path = os.path.join(self.tmp.name, "ged_2021.csv")
+        write_ged(other_path, 50, 2)
+        precleaning.load_cached(other_path, precleaning.get_ged_df)
+        other = [f for f in os.listdir(cache_dir) if f.startswith("ged_2021_")]
+        self.assertEqual(len(other), 1)
+        files = [f for f in os.listdir(cache_dir) if f not in other]
+
+        # Le .csv change : le cache est reconstruit et l'ancien supprimé, pas celui de l'autre fichier
+        write_ged(self.ged_path, 200, 1)
+        os.utime(self.ged_path, ns=(0, os.stat(self.ged_path).st_mtime_ns + 10**9))
+        df = precleaning.load_cached(self.ged_path, precleaning.get_ged_df)
+        pd.testing.assert_frame_equal(df, precleaning.get_ged_df(self.ged_path).reset_index(drop=True))
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertNotIn(files[0], os.listdir(cache_dir))
+        self.assertIn(other[0], os.listdir(cache_dir))
+
+        # Le code du nettoyage change : les anciens caches ne sont plus servis
+        version = precleaning.cache_version
+        try:
+            precleaning.cache_version = version + 1
+            precleaning.load_cached(self.ged_path, precleaning.get_ged_df)
+            ged_files = [f for f in os.listdir(cache_dir) if f != other[0]]
+            self.assertEqual(len(ged_files), 1)
+            self.assertTrue(ged_files[0].endswith(f"_v{version + 1}.parquet"))
+            self.assertIn(other[0], os.listdir(cache_dir))
+        finally:
+            precleaning.cache_version = version
+
+
 if __name__ == '__main__':
     unittest.main()
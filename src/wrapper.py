@@ -1,5 +1,5 @@
-import parameters, precleaning, exposure, exposure_numba, observation, figures
-from hmm import get_states, get_pi
+import parameters, precleaning, exposure, exposure_numba, observation, figures, grid
+from hmm import get_states, get_posteriors, get_pi
 
 def main():
     p = parameters.ask_params()
@@ -24,20 +24,45 @@ def main():
             res += "-" + str(countries[i])
         return res
 
+    fused = False
+    adaptive = False
     if use_numba:
-        print("\nComputing exposure to conventional warfare...")
-        Ec = exposure_numba.get_exposure(events, "conventional", p, freq)
+        fused = (input("Fused exposure/observation pipeline (lower memory) ? y/N > ") == "y") or False
+        adaptive = (input("Adaptive resolution (compact cells far from any event) ? y/N > ") == "y") or False
+
+    def export(df, axis=0):
+        # Les résultats d'une grille adaptative sont remis à la pleine résolution
+        return grid.uncompact_df(df, p.h3_level, axis) if adaptive else df
+
+    if fused:
+        save_exposures = (input("Save exposures ? y/N > ") == "y") or False
+        exposure_paths = None
+        if save_exposures:
+            exposure_paths = {attack_type: f"../exposures/exposure{numba_str}_{str_countries(countries)}_{attack_type}_{startdate}_{enddate}_{freq}.csv"
+                              for attack_type in ["conventional", "terrorism"]}
+
+        m = float(input("Enter a value for m (default is 0.15) > ") or 0.15)
+        xs = float(input("Enter a value for xs (default is 0.01) > ") or 0.01)
+
+        print("\nComputing exposures and observations...")
+        O = exposure_numba.get_observation_fused(events, p, freq, m, xs, exposure_paths=exposure_paths, adaptive=adaptive)
         print("Done !")
 
-        print("\nSaved exposure to conventional warfare to " + f"../exposures/exposure{numba_str}_{str_countries(countries)}_conventional_{startdate}_{enddate}_{freq}.csv")
-        Ec.to_csv(f"../exposures/exposure{numba_str}_{str_countries(countries)}_conventional_{startdate}_{enddate}_{freq}.csv")
+        if save_exposures:
+            print("\nSaved exposures to " + exposure_paths["conventional"] + " and " + exposure_paths["terrorism"])
 
-        print("\nComputing exposure to terrorism...")
-        Et = exposure_numba.get_exposure(events, "terrorism", p, freq)
+    elif use_numba:
+        # Les deux types sont calculés en un seul passage sur la même grille
+        print("\nComputing exposures to conventional warfare and terrorism...")
+        E = exposure_numba.get_exposures(events, ["conventional", "terrorism"], p, freq, adaptive=adaptive)
+        Ec, Et = E["conventional"], E["terrorism"]
         print("Done !")
-       
+
+        print("\nSaved exposure to conventional warfare to " + f"../exposures/exposure{numba_str}_{str_countries(countries)}_conventional_{startdate}_{enddate}_{freq}.csv")
+        export(Ec).to_csv(f"../exposures/exposure{numba_str}_{str_countries(countries)}_conventional_{startdate}_{enddate}_{freq}.csv")
+
         print("\nSaved exposure to terrorism to " + f"../exposures/exposure{numba_str}_{str_countries(countries)}_terrorism_{startdate}_{enddate}_{freq}.csv")
-        Et.to_csv(f"../exposures/exposure{numba_str}_{str_countries(countries)}_terrorism_{startdate}_{enddate}_{freq}.csv")
+        export(Et).to_csv(f"../exposures/exposure{numba_str}_{str_countries(countries)}_terrorism_{startdate}_{enddate}_{freq}.csv")
 
     else:
         print("\nComputing exposure to conventional warfare...")
@@ -55,35 +80,56 @@ def main():
         Et.to_csv(f"../exposures/exposure{numba_str}_{str_countries(countries)}_terrorism_{startdate}_{enddate}_{freq}.csv")
 
 
-    print("\nComputing exposition to conventional warfare probabilities...")
-    C = observation.get_probabilities(Ec)
-    print("Done !")
+    if not fused:
+        # Sur une grille adaptative, chaque ligne compte pour les cellules qu'elle représente
+        weights = grid.cell_weights(Ec.index, p.h3_level) if adaptive else None
 
-    print("\nComputing exposition to terrorism probabilities...")
-    T = observation.get_probabilities(Et)
-    print("Done !")
+        print("\nComputing exposition to conventional warfare probabilities...")
+        C = observation.get_probabilities(Ec, weights=weights)
+        print("Done !")
 
-    print(f"\nThe median of C is : {C.median().median()}")
-    print(f"The median of T is : {T.median().median()}")
+        print("\nComputing exposition to terrorism probabilities...")
+        T = observation.get_probabilities(Et, weights=weights)
+        print("Done !")
 
-    m = float(input("Enter a value for m (default is 0.15) > ") or 0.15)
-    xs = float(input("Enter a value for xs (default is 0.01) > ") or 0.01)
+        print(f"\nThe median of C is : {C.median().median()}")
+        print(f"The median of T is : {T.median().median()}")
 
-    print("\nComputing observations...")
-    O = observation.get_observation(Et,Ec,C,T,m,xs)
-    print("Done !")
+        m = float(input("Enter a value for m (default is 0.15) > ") or 0.15)
+        xs = float(input("Enter a value for xs (default is 0.01) > ") or 0.01)
+
+        print("\nComputing observations...")
+        O = observation.get_observation(Et,Ec,C,T,m,xs)
+        print("Done !")
 
     print("\nSaved observations to " + f"../observations/observation{numba_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.csv")
-    O.to_csv(f"../observations/observation{numba_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.csv")
+    export(O).to_csv(f"../observations/observation{numba_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.csv")
 
     pi = get_pi(countries[0])
 
+    # Le choix de Numba pour l'exposition ne change pas l'algorithme de décodage :
+    # Viterbi en log (qui peut donner d'autres états que la version linéaire sur
+    # les longues séquences) est un choix à part. Numba n'en est alors que l'implémentation.
+    use_log = (input("Decode controls with log-space Viterbi ? y/N > ") == "y") or False
+    if use_log:
+        engine, log_str = ("numba" if use_numba else "numpy_log"), "-log"
+    else:
+        engine, log_str = "numpy", ""
+
     print("\nApplying Viterbi algorithm to estimate territorial control...")
-    states_df = get_states(O, pi)
+    states_df = export(get_states(O, pi, engine=engine), axis=1)
     print("Done !")
     
-    print("\nSaved control to " + f"../controls/controls{numba_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.csv")
-    states_df.to_csv(f"../controls/controls{numba_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.csv")
+    print("\nSaved control to " + f"../controls/controls{numba_str}{log_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.csv")
+    states_df.to_csv(f"../controls/controls{numba_str}{log_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.csv")
+
+    posteriors = (input("Compute posterior probabilities ? y/N > ") == "y") or False
+    if posteriors:
+        print("\nComputing posterior probabilities of territorial control...")
+        get_posteriors(export(O), pi, path=f"../posteriors/posteriors{numba_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.npy")
+        print("Done !")
+
+        print("\nSaved posterior probabilities (cells x dates x states) to " + f"../posteriors/posteriors{numba_str}_{str_countries(countries)}_{startdate}_{enddate}_{freq}.npy")
 
 
     print("\nCreating figures (in ../figures)...")